@@ -7,7 +7,6 @@ import os
 import tempfile
 from pydub import AudioSegment
 import boto3
-import eyed3
 
 # AWS Polly voices data with associated costs per type
 polly_voices = {
@@ -33,6 +33,10 @@ splitting_substrings = { # Used for meeting character limit requirements
 	"-"		:""
 }
 
+# Every query is wrapped in a single speak tag, packed ssml goes in between
+_QUERY_PREFIX = "<speak>"
+_QUERY_SUFFIX = "</speak>"
+
 def replaceAll(string, mapping = reserved_characters):
 	for before,after in mapping.items():
 		string = string.replace(before,after)
@@ -273,11 +277,10 @@ def main(args):
         track["ssml_list"] = new_entries
 
     # Generating the final SSML queries
-    non_atribute_keys = {"content", "tag", "char_length", "ssml_length", "ssml"}
+    non_atribute_keys = {"content", "tag", "char_length", "ssml_length", "ssml", "ssml_bytes"}
     mark_format_string = ""
     if not args.no_mark:
         mark_format_string = "<mark name=\"{tag}{tag_count}\"/>"
-    query_format_string = "<speak>{text}</speak>"
     query_length = len("<speak>{text}</speak>")
 
     tag_count = 0
@@ -322,6 +325,7 @@ def main(args):
             tag_count += 1
 
             ssml_dict_item["ssml"] = total_ssml
+            ssml_dict_item["ssml_bytes"] = total_ssml.encode("ascii")
             ssml_dict_item["ssml_length"] = len(total_ssml)
             
             if (ssml_dict_item["ssml_length"] + query_length) > args.query_full_limit:
@@ -339,20 +343,20 @@ def main(args):
 
         ssml_query_list = []
         current_ssml_length = query_length
-        current_ssml = ""
+        # The ssml is pure ascii at this point, so a growable bytearray avoids re-copying the whole query on every append
+        current_ssml = bytearray()
         for ssml_dict_item in track["ssml_list"]:
-            current_ssml_portion = ssml_dict_item["ssml"]
+            current_ssml_portion = ssml_dict_item["ssml_bytes"]
             current_ssml_portion_length = len(current_ssml_portion)
 
-            if current_ssml_length + current_ssml_portion_length < args.query_full_limit:
-                current_ssml += current_ssml_portion
-                current_ssml_length = query_length + len(current_ssml)
-            else:
-                ssml_query_list.append(query_format_string.format(text=current_ssml))
-                current_ssml = current_ssml_portion
-                current_ssml_length = query_length + len(current_ssml)
+            if current_ssml_length + current_ssml_portion_length >= args.query_full_limit:
+                ssml_query_list.append(_QUERY_PREFIX + current_ssml.decode("ascii") + _QUERY_SUFFIX)
+                current_ssml.clear()
+
+            current_ssml.extend(current_ssml_portion)
+            current_ssml_length = query_length + len(current_ssml)
 
-        ssml_query_list.append(query_format_string.format(text=current_ssml))
+        ssml_query_list.append(_QUERY_PREFIX + current_ssml.decode("ascii") + _QUERY_SUFFIX)
         
         final_query_list.append({
             "name": trackname,
@@ -1,14 +1,27 @@
 #!/usr/bin/env python3
 import argparse
+import hashlib
 import json
+import logging
 import sys
 import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import closing
+from io import BytesIO
+from urllib.parse import unquote, urlparse
 from boto3 import Session
+from botocore.config import Config
 from botocore.exceptions import BotoCoreError, ClientError
-import eyed3
-from pydub import AudioSegment
-from io import BytesIO
+import orjson
+from mutagen.id3 import ID3, ID3NoHeaderError, TALB, TCON, TDOR, TDRC, TDRL, TDTG, TIT2, TPE1, TPE2, TPUB, TRCK
+
+logger = logging.getLogger(__name__)
 
 # AWS Polly voices data with associated costs per type
 polly_voices = {
@@ -58,76 +71,124 @@ polly_voices = {
     ],
 }
 
+# Cost per million characters, keyed on (language, voice name, voice type)
+_COST = {
+    (language, voice["name"], voice_type): price
+    for language, voices in polly_voices.items()
+    for voice in voices
+    for voice_type, price in voice["types"].items()
+}
+
+# Number of tracks rendered at once
+_TRACK_WORKERS = 8
+
+# Number of threads writing the JSON, LRC, and TXT files of finished tracks
+_IO_WORKERS = 4
+
+# Number of SSML pieces of a track (each an audio and a speech marks request) submitted ahead of the one being written
+_PIECE_WINDOW = 8
+
+# Most requests in flight with Polly at once, shared by every track; the connection pools are sized to match
+_MAX_POLLY_REQUESTS = 32
+_POLLY_REQUESTS = threading.BoundedSemaphore(_MAX_POLLY_REQUESTS)
+
+# Tracks with more SSML than this are synthesized with asynchronous Polly tasks when an S3 bucket is given
+_TASK_MIN_CHARS = 20000
+
+# Longest SSML sent as a single asynchronous task, within Polly's limit of 100,000 billed characters per task
+_TASK_MAX_CHARS = 100000
+
+# Most asynchronous tasks running at once, shared by every track. A slot is held from starting a task until its output
+# has been read back from S3, which also bounds the S3 requests in flight
+_MAX_RUNNING_TASKS = 8
+_RUNNING_TASKS = threading.BoundedSemaphore(_MAX_RUNNING_TASKS)
+
+# Bounds on the wait between checks on an asynchronous task, in seconds
+_TASK_POLL_MIN = 1
+_TASK_POLL_MAX = 30
+
+# Key prefix in the S3 bucket that asynchronous task output is written under. Each object is deleted once it has been
+# read, but a run that is killed part way through can leave some behind, so a lifecycle rule expiring the prefix is
+# worth adding to the bucket
+_TASK_KEY_PREFIX = "polly-tasks/"
+
+# Progress is logged at info level once every this many pieces of a track
+_LOG_EVERY = 25
+
+# Where Polly responses are cached by default: the user's cache directory rather than the book's output folder, so the
+# cache isn't shipped with the tracks. walkEPUBStructure.py caches the same responses in the same place
+_DEFAULT_CACHE_DIR = os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), "tts_epub")
+
+# Chunk size used when streaming audio to disk
+_COPY_CHUNK = 1 << 16
+
+# Pieces longer than this are split into smaller queries, which Polly can synthesize in parallel
+_MAX_PIECE_CHARS = 1400
+
+# Any opening, closing, or self-closing SSML tag
+_SSML_TAG = re.compile(r"<(/?)[^>]*?(/?)>")
+
 def calculate_cost(ssml_queries, selected_voice, verbose=False):
     voice_language = selected_voice["language"]
     voice_name = selected_voice["name"]
     voice_type = selected_voice["type"]
 
     # Find the cost per million characters based on the voice and type
-    cost_per_million = None
-    for voice in polly_voices.get(voice_language, []):
-        if voice["name"] == voice_name and voice_type in voice["types"]:
-            cost_per_million = voice["types"][voice_type]
-            break
+    cost_per_million = _COST.get((voice_language, voice_name, voice_type))
 
     if cost_per_million is None:
         raise ValueError(f"Cost not found for voice {voice_name} with type {voice_type}")
 
     # Calculate the total cost based on the number of characters in the SSML
-    total_characters = 0
-    for track in ssml_queries:
-        for query in track["ssml_queries"]:
-            char_count = len(query)
-            total_characters += char_count
-            if verbose:
-                print(f"Track: {track['metadata']['title']} - Query length: {char_count} characters")
+    total_characters = sum(len(query) for track in ssml_queries for query in track["ssml_queries"])
 
     if verbose:
-        print(f"Total characters across all SSML queries: {total_characters}")
+        if logger.isEnabledFor(logging.DEBUG):
+            for track in ssml_queries:
+                for query in track["ssml_queries"]:
+                    logger.debug("Track: %s - Query length: %d characters", track["metadata"]["title"], len(query))
+        logger.info("Total characters across all SSML queries: %d", total_characters)
 
     total_cost = (total_characters / 1_000_000) * cost_per_million
 
     return total_cost
 
-def add_id3_tags(output_filename, track_metadata):
+def add_id3_tags(audio_file, track_metadata, output_filename):
     """
-    Add ID3 tags to an MP3 file using the metadata provided.
+    Add ID3 tags to MP3 audio using the metadata provided.
 
     Args:
-        output_filename (str): Path to the MP3 file.
+        audio_file (str or file object): Path to the MP3 file, or a seekable file object holding the MP3 data.
         track_metadata (dict): Metadata information to apply as ID3 tags.
+        output_filename (str): Name of the MP3 file, used for messages.
     """
-    audiofile = eyed3.load(output_filename)
-
-    if audiofile is None:
-        print(f"Error: Failed to load MP3 file {output_filename}")
-        return
-
-    if not audiofile.tag:
-        audiofile.initTag()
+    try:
+        tags = ID3(audio_file)
+    except ID3NoHeaderError:
+        tags = ID3()
 
-    # Map the metadata keys to the corresponding ID3 tag fields
+    # Map the metadata keys to the corresponding ID3 tag frames
     if "ARTIST" in track_metadata:
-        audiofile.tag.artist = track_metadata["ARTIST"]
+        tags.add(TPE1(encoding=3, text=track_metadata["ARTIST"]))
 
     if "ALBUM" in track_metadata:
-        audiofile.tag.album = track_metadata["ALBUM"]
+        tags.add(TALB(encoding=3, text=track_metadata["ALBUM"]))
 
     if "ALBUMARTIST" in track_metadata:
-        audiofile.tag.album_artist = track_metadata["ALBUMARTIST"]
+        tags.add(TPE2(encoding=3, text=track_metadata["ALBUMARTIST"]))
 
     if "TITLE" in track_metadata:
-        audiofile.tag.title = track_metadata["TITLE"]
+        tags.add(TIT2(encoding=3, text=track_metadata["TITLE"]))
 
     if "TRACK" in track_metadata:
-        audiofile.tag.track_num = track_metadata["TRACK"]
+        tags.add(TRCK(encoding=3, text=str(track_metadata["TRACK"])))
 
     if "DATE" in track_metadata:
         date_value = track_metadata["DATE"]
         
         if date_value:
             # Set release date, original release date, recording date, and year
-            audiofile.tag.release_date = date_value
+            tags.add(TDRL(encoding=3, text=date_value))
             
             # Attempt to parse the year from the date
             year_value = None
@@ -135,45 +196,144 @@ def add_id3_tags(output_filename, track_metadata):
                 year_value = date_value[:4]
                 
             if year_value:
-                audiofile.tag.recording_date = year_value
-                audiofile.tag.original_release_date = year_value
-                audiofile.tag.tagging_date = year_value  # Often used for the year
-                
-                # Set the year (older ID3v2.3)
-                audiofile.tag.year = year_value
+                tags.add(TDRC(encoding=3, text=year_value))  # Also written as the year for older ID3v2.3 readers
+                tags.add(TDOR(encoding=3, text=year_value))
+                tags.add(TDTG(encoding=3, text=year_value))
         else:
-            print(f"Warning: 'DATE' metadata is missing or invalid for {output_filename}. Skipping date tags.")
+            logger.warning("'DATE' metadata is missing or invalid for %s. Skipping date tags.", output_filename)
 
     if "PUBLISHER" in track_metadata:
-        audiofile.tag.publisher = track_metadata["PUBLISHER"]
+        tags.add(TPUB(encoding=3, text=track_metadata["PUBLISHER"]))
 
     # The genre can be set to Audiobook (ID3 genre 183) if not specified
-    genre = str(audiofile.tag.genre).lower() if audiofile.tag.genre else "audiobook"
+    genre = str(tags["TCON"]).lower() if "TCON" in tags else "audiobook"
     if genre == "audiobook":
-        audiofile.tag.genre = 183  # Set to Audiobook genre code
+        tags.add(TCON(encoding=3, text="(183)"))  # Audiobook genre code
 
     # Save the changes to the file
     try:
-        audiofile.tag.save()
-        print(f"Successfully saved ID3 tags to {output_filename}")
+        tags.save(audio_file)
+        logger.info("Successfully saved ID3 tags to %s", output_filename)
     except Exception as e:
-        print(f"Error saving ID3 tags to {output_filename}: {e}")
+        logger.error("Error saving ID3 tags to %s: %s", output_filename, e)
+
+# MPEG audio frame header tables, indexed by the version bits (0: MPEG 2.5, 2: MPEG 2, 3: MPEG 1) and layer bits (1: III, 2: II, 3: I)
+_MP3_SAMPLE_RATES = {
+    0: (11025, 12000, 8000),
+    2: (22050, 24000, 16000),
+    3: (44100, 48000, 32000),
+}
+_MP3_BITRATES_KBPS = {
+    (3, 3): (0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448),
+    (3, 2): (0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384),
+    (3, 1): (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+    (2, 3): (0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256),
+    (2, 2): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+    (2, 1): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+}
+
+def parse_mp3_frame_header(header):
+    """
+    Parse a 4 byte MPEG audio frame header.
+
+    Args:
+        header (bytes): The 4 bytes at the start of a candidate frame.
+
+    Returns:
+        tuple: (frame length in bytes, samples in the frame, sample rate), or None if the bytes are not a valid header.
+    """
+    if header[0] != 0xFF or (header[1] & 0xE0) != 0xE0:
+        return None
 
+    version = (header[1] >> 3) & 0x03
+    layer = (header[1] >> 1) & 0x03
+    bitrate_index = header[2] >> 4
+    sample_rate_index = (header[2] >> 2) & 0x03
+    padding = (header[2] >> 1) & 0x01
 
+    if version == 1 or layer == 0 or bitrate_index in (0, 15) or sample_rate_index == 3:
+        return None
 
+    sample_rate = _MP3_SAMPLE_RATES[version][sample_rate_index]
+    bitrate = _MP3_BITRATES_KBPS[(3 if version == 3 else 2, layer)][bitrate_index] * 1000
 
-def calculate_audio_duration(audio_content):
+    if layer == 3:
+        samples = 384
+        frame_length = (12 * bitrate // sample_rate + padding) * 4
+    else:
+        samples = 576 if layer == 1 and version != 3 else 1152
+        frame_length = samples // 8 * bitrate // sample_rate + padding
+
+    return frame_length, samples, sample_rate
+
+class Mp3DurationCounter:
+    """
+    Count the duration of MP3 audio from its frame headers as it is streamed through in chunks, without decoding any audio.
     """
-    Calculate the duration of an MP3 audio stream.
+    def __init__(self):
+        self.duration = 0.0
+        self._pending = b""  # Start of a frame header split across chunks
+        self._skip = 0  # Bytes left in the current frame (or ID3v2 tag) that are still to come
+        self._at_start = True
+
+    def feed(self, chunk):
+        data = self._pending + chunk if self._pending else chunk
+        position = 0
+
+        if self._at_start:
+            if len(data) < 10:
+                self._pending = bytes(data)
+                return
+            self._at_start = False
+
+            # Skip over an ID3v2 tag, if there is one
+            if data[:3] == b"ID3":
+                tag_size = (data[6] << 21) | (data[7] << 14) | (data[8] << 7) | data[9]
+                self._skip = 10 + tag_size + (10 if data[5] & 0x10 else 0)
+
+        if self._skip >= len(data):
+            self._skip -= len(data)
+            self._pending = b""
+            return
+        position, self._skip = self._skip, 0
+
+        while position + 4 <= len(data):
+            frame = parse_mp3_frame_header(data[position:position + 4])
+            if frame is None:
+                # Not on a frame boundary, step forward until the next sync word
+                position += 1
+                continue
+
+            frame_length, samples, sample_rate = frame
+            self.duration += samples * 1000 / sample_rate
+            position += frame_length
+
+        if position > len(data):
+            self._skip = position - len(data)
+            self._pending = b""
+        else:
+            self._pending = bytes(data[position:])
+
+    def duration_ms(self):
+        """
+        Returns:
+            int: Duration of the audio fed so far, in milliseconds.
+        """
+        return round(self.duration)
+
+def mp3_duration_ms(buf):
+    """
+    Calculate the duration of MP3 audio by walking its frame headers, without decoding any audio.
 
     Args:
-        audio_content (bytes): The raw audio data.
+        buf (bytes): The raw MP3 data.
 
     Returns:
-        float: Duration of the audio in milliseconds.
+        int: Duration of the audio in milliseconds.
     """
-    audio = AudioSegment.from_mp3(BytesIO(audio_content))
-    return len(audio)  # duration in milliseconds
+    counter = Mp3DurationCounter()
+    counter.feed(buf)
+    return counter.duration_ms()
 
 def generate_lyrics(ssmlJSON, track_metadata):
     """
@@ -186,52 +346,312 @@ def generate_lyrics(ssmlJSON, track_metadata):
     Returns:
         tuple: Formatted lyrics in LRC format and plain text format.
     """
-    lrc_lyrics = ""
-    txt_lyrics = ""
     current_paragraph = []
 
-    # Add metadata to the LRC lyrics
-    lrc_lyrics += "[ar:{artist}]\n".format(artist=track_metadata.get("artist", "Unknown Artist"))
-    lrc_lyrics += "[al:{album}]\n".format(album=track_metadata.get("album", "Unknown Album"))
-    lrc_lyrics += "[ti:{title}]\n".format(title=track_metadata.get("title", "Unknown Title"))
-    lrc_lyrics += "\n"  # Add a newline for readability
+    # Add metadata to the LRC lyrics, with a newline after for readability
+    lrc_parts = [
+        f"[ar:{track_metadata.get('artist', 'Unknown Artist')}]\n",
+        f"[al:{track_metadata.get('album', 'Unknown Album')}]\n",
+        f"[ti:{track_metadata.get('title', 'Unknown Title')}]\n",
+        "\n",
+    ]
+    txt_parts = []
 
     currentTimeZero = 0
+    lrc_line = "[{:02d}:{:02d}.{:02d}]{}\n".format
+    append_lrc = lrc_parts.append
+    append_sentence = current_paragraph.append
 
     for ssmlMark in ssmlJSON:
-        if ssmlMark["type"] == "sentence":
-            time = ssmlMark["time"] + currentTimeZero
-            minutes = time // (60 * 1000)
-            time -= minutes * (60 * 1000)
-            seconds = time // 1000
-            time -= seconds * 1000
-            hundredths = time // 10
+        mark_type = ssmlMark["type"]
+        if mark_type == "sentence":
+            minutes, milliseconds = divmod(ssmlMark["time"] + currentTimeZero, 60 * 1000)
+            seconds, milliseconds = divmod(milliseconds, 1000)
 
             value = ssmlMark["value"]
-            lrc_lyrics += "[{mm:02d}:{ss:02d}.{xx:02d}]{value}\n".format(mm=minutes, ss=seconds, xx=hundredths, value=value)
+            append_lrc(lrc_line(minutes, seconds, milliseconds // 10, value))
 
             # Add the sentence to the current paragraph
-            current_paragraph.append(value)
+            append_sentence(value)
+
+        elif mark_type == "preceding_realtime":
+            currentTimeZero += ssmlMark["time"]
 
-        elif ssmlMark["type"] == "ssml":
+        elif mark_type == "ssml":
             # End the current paragraph
             if current_paragraph:
-                txt_lyrics += " ".join(current_paragraph) + "\n"
-                current_paragraph = []
+                txt_parts.append(" ".join(current_paragraph) + "\n")
+                current_paragraph.clear()
 
-        elif ssmlMark["type"] == "preceding_realtime":
-            currentTimeZero += ssmlMark["time"]
-
-    # If there's any remaining paragraph content, add it to txt_lyrics
+    # If there's any remaining paragraph content, add it to the text lyrics
     if current_paragraph:
-        txt_lyrics += " ".join(current_paragraph) + "\n"
+        txt_parts.append(" ".join(current_paragraph) + "\n")
+
+    return "".join(lrc_parts), "".join(txt_parts)
+
+
+def split_ssml(piece, max_chars=_MAX_PIECE_CHARS):
+    """
+    Split an SSML query into smaller queries, only between its top level elements so every part stays valid SSML.
+
+    Args:
+        piece (str): The SSML query, wrapped in a speak tag.
+        max_chars (int): The target maximum length of each query.
 
-    return lrc_lyrics, txt_lyrics
+    Returns:
+        list: The SSML queries, each wrapped in its own speak tag. Pieces that are short enough or can't be split are returned as is.
+    """
+    piece = piece.strip()
+    if len(piece) <= max_chars or not (piece.startswith("<speak>") and piece.endswith("</speak>")):
+        return [piece]
+
+    body = piece[len("<speak>"):-len("</speak>")]
+    max_body_chars = max_chars - len("<speak></speak>")
+
+    # Find where each top level element ends, keeping a paragraph's trailing mark attached to it
+    boundaries = []
+    depth = 0
+    for tag in _SSML_TAG.finditer(body):
+        is_closing, is_self_closing = tag.group(1), tag.group(2)
+        if is_closing:
+            depth -= 1
+        elif not is_self_closing:
+            depth += 1
+
+        if depth == 0 and not body.startswith("<mark", tag.end()):
+            boundaries.append(tag.end())
+
+    sub_bodies = []
+    start = 0
+    last_boundary = 0
+    for boundary in boundaries + [len(body)]:
+        if boundary - start > max_body_chars and last_boundary > start:
+            sub_bodies.append(body[start:last_boundary])
+            start = last_boundary
+        last_boundary = boundary
+    sub_bodies.append(body[start:])
+
+    return [f"<speak>{sub_body}</speak>" for sub_body in sub_bodies if sub_body]
+
+def _create_clients(with_s3=False):
+    """
+    Create the Polly client shared by every track and piece worker thread, and the S3 client when asynchronous tasks
+    are used. They are only created once a run needs them, so --help and the cost prompt work without AWS configured.
+
+    Args:
+        with_s3 (bool): Whether to also create the S3 client that task output is read through.
 
+    Returns:
+        tuple: The Polly client, and the S3 client or None.
+    """
+    # The connection pools hold every request _POLLY_REQUESTS lets through, so concurrent requests keep their
+    # connections rather than urllib3 opening and discarding extra ones, and adaptive retries back off when Polly
+    # throttles them
+    config = Config(
+        max_pool_connections=_MAX_POLLY_REQUESTS,
+        retries={"max_attempts": 10, "mode": "adaptive"},
+    )
+    session = Session()
+    polly = session.client("polly", config=config)
+    s3 = session.client("s3", config=config) if with_s3 else None
+    return polly, s3
 
-def readEntryWithPolly(entry, outfilename, voiceID, engine, track_metadata):
+def piece_cache_path(cache_dir, piece, voiceID, engine, output_format):
     """
-    Converts SSML to speech using Amazon Polly and writes the result to an MP3 file.
+    Find where the Polly response for a piece is cached, keyed on a hash of the SSML.
+
+    Args:
+        cache_dir (str): The root directory of the cache.
+        piece (str): The SSML query.
+        voiceID (str): The ID of the Polly voice used.
+        engine (str): The Polly engine used.
+        output_format (str): "mp3" or "json".
+
+    Returns:
+        str: The path of the cached response, which may not exist yet.
+    """
+    piece_hash = hashlib.blake2b(piece.encode("utf-8")).hexdigest()
+    return os.path.join(cache_dir, voiceID, engine, f"{piece_hash}.{output_format}")
+
+def join_ssml(queries, max_chars=_TASK_MAX_CHARS):
+    """
+    Join SSML queries into as few queries as possible, by concatenating the contents of their speak tags.
+
+    Args:
+        queries (list): The SSML queries, each wrapped in a speak tag.
+        max_chars (int): The maximum length of each joined query.
+
+    Returns:
+        list: The joined SSML queries, each wrapped in its own speak tag. Queries that aren't wrapped in a speak tag are returned as is.
+    """
+    joined = []
+    bodies = []
+    length = len("<speak></speak>")
+    for query in queries:
+        query = query.strip()
+        is_speak = query.startswith("<speak>") and query.endswith("</speak>")
+        body = query[len("<speak>"):-len("</speak>")] if is_speak else None
+
+        # Start a new query when this one can't be joined or won't fit
+        if bodies and (not is_speak or length + len(body) + 1 > max_chars):
+            joined.append(f"<speak>{' '.join(bodies)}</speak>")
+            bodies = []
+            length = len("<speak></speak>")
+
+        if not is_speak:
+            joined.append(query)
+            continue
+        bodies.append(body)
+        length += len(body) + 1
+
+    if bodies:
+        joined.append(f"<speak>{' '.join(bodies)}</speak>")
+    return joined
+
+def synthesize_piece_task(polly, s3, piece, voiceID, engine, output_format, s3_bucket, extra_args):
+    """
+    Synthesize a single SSML piece with an asynchronous Polly task, and read back its output from S3. The output
+    object is deleted once it has been read, so a run doesn't leave its pieces in the bucket. At most
+    _MAX_RUNNING_TASKS tasks run at once across every track.
+
+    Args:
+        polly: The boto3 Polly client to use.
+        s3: The boto3 S3 client to read the task output with.
+        piece (str): The SSML query to synthesize.
+        voiceID (str): The ID of the Polly voice to use.
+        engine (str): The Polly engine to use (standard, neural, long-form, generative).
+        output_format (str): "mp3" for the audio, or "json" for the speech marks.
+        s3_bucket (str): The S3 bucket Polly writes the task output to.
+        extra_args (dict): Any further arguments for the task, such as the speech mark types.
+
+    Returns:
+        file object: A readable binary stream of the task output. The caller closes it.
+    """
+    with _RUNNING_TASKS:
+        with _POLLY_REQUESTS:
+            task = polly.start_speech_synthesis_task(
+                Text=piece, TextType="ssml", OutputFormat=output_format,
+                VoiceId=voiceID, Engine=engine,
+                OutputS3BucketName=s3_bucket, OutputS3KeyPrefix=_TASK_KEY_PREFIX, **extra_args
+            )["SynthesisTask"]
+
+        # Check on the task with exponential backoff until it is done
+        delay = _TASK_POLL_MIN
+        while task["TaskStatus"] in ("scheduled", "inProgress"):
+            time.sleep(delay)
+            delay = min(delay * 2, _TASK_POLL_MAX)
+            with _POLLY_REQUESTS:
+                task = polly.get_speech_synthesis_task(TaskId=task["TaskId"])["SynthesisTask"]
+
+        if task["TaskStatus"] != "completed":
+            raise IOError(f"Polly task {task['TaskId']} {task['TaskStatus']}: {task.get('TaskStatusReason', '')}")
+
+        # The output URI may be path or virtual-hosted style, either way the path ends with the object key
+        key = unquote(urlparse(task["OutputUri"]).path).lstrip("/")
+        if key.startswith(f"{s3_bucket}/"):
+            key = key[len(s3_bucket) + 1:]
+
+        # Read the whole output before deleting it
+        try:
+            with closing(s3.get_object(Bucket=s3_bucket, Key=key)["Body"]) as body:
+                return BytesIO(body.read())
+        finally:
+            s3.delete_object(Bucket=s3_bucket, Key=key)
+
+def synthesize_piece(polly, piece, voiceID, engine, output_format, cache_dir=None, s3_bucket=None, s3=None):
+    """
+    Request a single SSML piece from Polly, reusing a cached response if there is one. Only complete responses are
+    ever cached, so a rerun after a crash resumes from the pieces that were already synthesized.
+
+    Args:
+        polly: The boto3 Polly client to use.
+        piece (str): The SSML query to synthesize.
+        voiceID (str): The ID of the Polly voice to use.
+        engine (str): The Polly engine to use (standard, neural, long-form, generative).
+        output_format (str): "mp3" for the audio, or "json" for the ssml and sentence speech marks.
+        cache_dir (str): Directory to cache Polly responses in, or None to always call Polly.
+        s3_bucket (str): S3 bucket to synthesize through with an asynchronous task, or None to call Polly directly.
+        s3: The boto3 S3 client to read task output with, needed when s3_bucket is given.
+
+    Returns:
+        file object: A readable binary stream of the response, either the cached file or Polly's output. The caller closes it.
+    """
+    cache_path = None
+    if cache_dir:
+        cache_path = piece_cache_path(cache_dir, piece, voiceID, engine, output_format)
+        if os.path.exists(cache_path):
+            return open(cache_path, "rb")
+
+    extra_args = {"SpeechMarkTypes": ["ssml", "sentence"]} if output_format == "json" else {}
+    if s3_bucket:
+        source = synthesize_piece_task(polly, s3, piece, voiceID, engine, output_format, s3_bucket, extra_args)
+    else:
+        # The response is read in full while holding a request slot, so its connection is back in the pool by the
+        # time the slot is released; a piece is at most a few hundred kilobytes
+        with _POLLY_REQUESTS:
+            response = polly.synthesize_speech(
+                Text=piece, TextType="ssml", OutputFormat=output_format,
+                VoiceId=voiceID, Engine=engine, **extra_args
+            )
+
+            if "AudioStream" not in response:
+                raise IOError(f"Could not stream {output_format} from Polly")
+            with closing(response["AudioStream"]) as stream:
+                source = BytesIO(stream.read())
+
+    if not cache_path:
+        return source
+
+    # Write to a temporary file and move it into place once complete, so a run that
+    # is interrupted part way through never leaves a truncated response in the cache
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    with closing(source) as stream, tempfile.NamedTemporaryFile(
+        dir=os.path.dirname(cache_path), suffix=".part", delete=False
+    ) as cached:
+        try:
+            shutil.copyfileobj(stream, cached, _COPY_CHUNK)
+        except BaseException:
+            cached.close()
+            os.remove(cached.name)
+            raise
+    os.replace(cached.name, cache_path)
+
+    return open(cache_path, "rb")
+
+def submit_pieces(executor, polly, pieces, voiceID, engine, cache_dir=None, s3_bucket=None, s3=None, window=_PIECE_WINDOW):
+    """
+    Submit the audio and speech marks requests of every piece, keeping at most window pieces in flight.
+
+    Args:
+        executor (ThreadPoolExecutor): The executor to run the Polly requests on.
+        polly: The boto3 Polly client to use.
+        pieces (list): The SSML queries to synthesize.
+        voiceID (str): The ID of the Polly voice to use.
+        engine (str): The Polly engine to use (standard, neural, long-form, generative).
+        cache_dir (str): Directory to cache Polly responses in, or None to always call Polly.
+        s3_bucket (str): S3 bucket to synthesize through with asynchronous tasks, or None to call Polly directly.
+        s3: The boto3 S3 client to read task output with, needed when s3_bucket is given.
+        window (int): The number of pieces allowed in flight at once.
+
+    Yields:
+        tuple: The (audio, speech marks) futures of each piece, in the original order.
+    """
+    pending = deque()
+    for piece in pieces:
+        pending.append((
+            executor.submit(synthesize_piece, polly, piece, voiceID, engine, "mp3", cache_dir, s3_bucket, s3),
+            executor.submit(synthesize_piece, polly, piece, voiceID, engine, "json", cache_dir, s3_bucket, s3),
+        ))
+        if len(pending) >= window:
+            yield pending.popleft()
+
+    while pending:
+        yield pending.popleft()
+
+def readEntryWithPolly(entry, outfilename, voiceID, engine, track_metadata, polly, cache_dir=None, s3_bucket=None, s3=None):
+    """
+    Converts SSML to speech using Amazon Polly and writes the result to an MP3 file. If a request fails the error is
+    raised to the caller, and no MP3 is left at outfilename.
 
     Args:
         entry (dict): The entry containing SSML queries to be converted.
@@ -239,72 +659,74 @@ def readEntryWithPolly(entry, outfilename, voiceID, engine, track_metadata):
         voiceID (str): The ID of the Polly voice to use.
         engine (str): The Polly engine to use (standard, neural, long-form, generative).
         track_metadata (dict): Metadata information to apply as ID3 tags.
+        polly: The boto3 Polly client to use.
+        cache_dir (str): Directory to cache Polly responses in, or None to always call Polly.
+        s3_bucket (str): S3 bucket to synthesize through with asynchronous tasks, or None to call Polly directly.
+        s3: The boto3 S3 client to read task output with, needed when s3_bucket is given.
 
     Returns:
         dict: Dictionary containing the SSML speech marks JSON response from Polly, with additional timing information and lyrics.
     """
-    session = Session()
-    polly = session.client("polly")
-
-    print(f"Generating MP3: {outfilename} with voiceID: {voiceID} using engine: {engine}")
+    logger.info("Generating MP3: %s with voiceID: %s using engine: %s", outfilename, voiceID, engine)
     
-    # Use 'ssml_queries' instead of 'ssml' as per the structure of 'entry'
-    pieces = entry["ssml_queries"]
-    chapterJSON = ""
+    # Use 'ssml_queries' instead of 'ssml' as per the structure of 'entry'. Direct requests are split into smaller
+    # pieces to pipeline them, while asynchronous tasks take the queries joined into as few tasks as possible
+    if s3_bucket:
+        pieces = join_ssml(entry["ssml_queries"])
+    else:
+        pieces = [sub_piece for piece in entry["ssml_queries"] for sub_piece in split_ssml(piece)]
     ssmlJSON = []
     section_durations = []
 
-    with open(outfilename, "wb") as out:
-        for i, piece in enumerate(pieces, start=1):
-            print(f"Processing piece {i} of {len(pieces)}")
+    # The ID3 tag only depends on the metadata, so it is built up front and written ahead of the audio
+    tag_buf = BytesIO()
+    add_id3_tags(tag_buf, track_metadata, outfilename)
+
+    # Pieces are requested concurrently, but always written out in order. The audio goes to a partial file that is
+    # only moved into place once complete, so a failed track never leaves a truncated MP3 behind
+    partial_filename = outfilename + ".part"
+    with ThreadPoolExecutor(max_workers=2 * _PIECE_WINDOW) as executor, open(partial_filename, "wb", buffering=1 << 20) as out:
+        try:
+            out.write(tag_buf.getvalue())
+
+            requests = submit_pieces(executor, polly, pieces, voiceID, engine, cache_dir, s3_bucket, s3)
+            for i, (audio_request, json_request) in enumerate(requests, start=1):
+                # Per piece progress is only logged at debug level, with a summary every _LOG_EVERY pieces
+                logger.debug("Processing piece %d of %d of %s", i, len(pieces), outfilename)
+                if i % _LOG_EVERY == 0 or i == len(pieces):
+                    logger.info("Processed %d of %d pieces of %s", i, len(pieces), outfilename)
+
+                # Stream the audio to disk, timing it from the frame headers on the way through
+                duration_counter = Mp3DurationCounter()
+                with closing(json_request.result()) as json_stream:
+                    json_content = json_stream.read()
+
+                with closing(audio_request.result()) as audio_stream:
+                    for chunk in iter(lambda: audio_stream.read(_COPY_CHUNK), b""):
+                        out.write(chunk)
+                        duration_counter.feed(chunk)
+
+                # Duration (length in milliseconds) of the current audio piece
+                duration = duration_counter.duration_ms()
+                section_durations.append(duration)
+
+                # The speech marks are newline delimited JSON, one mark per line
+                current_ssmlJSON = [orjson.loads(line) for line in json_content.splitlines() if line]
 
-            try:
-                responseAudio = polly.synthesize_speech(
-                    Text=piece, TextType="ssml", OutputFormat="mp3", 
-                    VoiceId=voiceID, Engine=engine
-                )
-                responseJSON = polly.synthesize_speech(
-                    Text=piece, TextType="ssml", OutputFormat="json", 
-                    SpeechMarkTypes=["ssml", "sentence"], VoiceId=voiceID, Engine=engine
-                )
-            except (BotoCoreError, ClientError) as error:
-                print(f"Error: {error}")
-                sys.exit(-1)
-
-            # Extract duration of the audio
-            if "AudioStream" in responseAudio:
-                with closing(responseAudio["AudioStream"]) as stream:
-                    audio_content = stream.read()
-                    out.write(audio_content)
-
-                    # Calculate duration (length in milliseconds) of the current audio piece
-                    duration = calculate_audio_duration(audio_content)
-                    section_durations.append(duration)
-            else:
-                print("Could not stream audio")
-                sys.exit(-1)
-
-            if "AudioStream" in responseJSON:
-                with closing(responseJSON["AudioStream"]) as stream:
-                    try:
-                        json_content = stream.read().decode("utf-8")
-                        chapterJSON = json_content  # Store a single line to avoid repetition
-                    except IOError as error:
-                        print(f"Error: {error}")
-                        sys.exit(-1)
-
-                # Convert the current JSON content to a list of dicts
-                current_ssmlJSON = json.loads("[" + ','.join(chapterJSON[:-1].split('\n')) + "]")
-                
                 # Append the SSML JSON entries
                 ssmlJSON.extend(current_ssmlJSON)
-                
+
                 # Append the corresponding preceding_realtime entry
                 preceding_realtime_entry = {"time": duration, "type": "preceding_realtime"}
                 ssmlJSON.append(preceding_realtime_entry)
+        except BaseException:
+            # Drop the pieces that haven't started yet and the partial file, and let the caller handle the error
+            executor.shutdown(wait=False, cancel_futures=True)
+            out.close()
+            os.remove(partial_filename)
+            raise
 
-    # Add ID3 tags to the MP3 file
-    add_id3_tags(outfilename, track_metadata)
+    os.replace(partial_filename, outfilename)
 
     # Generate lyrics
     lrc_lyrics, txt_lyrics = generate_lyrics(ssmlJSON, track_metadata)
@@ -314,42 +736,103 @@ def readEntryWithPolly(entry, outfilename, voiceID, engine, track_metadata):
 
     return {"ssmlJSON": ssmlJSON, "lrc_lyrics": lrc_lyrics, "txt_lyrics": txt_lyrics}
 
-def process_ssml_queries(ssml_queries, selected_voice, output_dir):
-    engine = selected_voice["type"]
-    voiceID = selected_voice["name"]
+def _write_sidecars(track_name, ssml_json_filename, ssml_json, lrc_filename, lrc_lyrics, txt_filename, txt_lyrics):
+    """
+    Write the JSON, LRC, and TXT files that accompany a track's MP3.
 
-    for i, track in enumerate(ssml_queries):
-        track_number = track["metadata"]["track"]
-        track_title = track["metadata"]["title"]
-        base_filename = f"{track_number} - {track_title}"
+    Args:
+        track_name (str): The track number and title, for the progress message.
+        ssml_json_filename (str): The output path of the SSML speech marks JSON.
+        ssml_json (list): The SSML speech marks, with the timing information added.
+        lrc_filename (str): The output path of the LRC lyrics.
+        lrc_lyrics (str): The lyrics in LRC format.
+        txt_filename (str): The output path of the plain text lyrics.
+        txt_lyrics (str): The lyrics in plain text format.
+    """
+    # Save SSML JSON
+    with open(ssml_json_filename, "wb") as json_file:
+        json_file.write(orjson.dumps(ssml_json, option=orjson.OPT_INDENT_2))
 
-        output_filename = os.path.join(output_dir, f"{base_filename}.mp3")
-        ssml_json_filename = os.path.join(output_dir, f"{base_filename}.json")
-        lrc_filename = os.path.join(output_dir, f"{base_filename}.lrc")
-        txt_filename = os.path.join(output_dir, f"{base_filename}.txt")
+    # Save Lyrics as LRC
+    with open(lrc_filename, "w") as lrc_file:
+        lrc_file.write(lrc_lyrics)
 
-        track_metadata = track["metadata"]
-        result = readEntryWithPolly(track, output_filename, voiceID, engine, track_metadata)
-        ssml_json = result["ssmlJSON"]
-        lrc_lyrics = result["lrc_lyrics"]
-        txt_lyrics = result["txt_lyrics"]
+    # Save Lyrics as TXT
+    with open(txt_filename, "w") as txt_file:
+        txt_file.write(txt_lyrics)
 
-        # Save SSML JSON
-        with open(ssml_json_filename, "w") as json_file:
-            json.dump(ssml_json, json_file, indent=4, ensure_ascii=False)
+    logger.info("Generated MP3, JSON, LRC, and TXT files for track %s.", track_name)
 
-        # Save Lyrics as LRC
-        with open(lrc_filename, "w") as lrc_file:
-            lrc_file.write(lrc_lyrics)
+def _render_track(track, selected_voice, output_dir, polly, cache_dir=None, s3_bucket=None, s3=None, io_executor=None):
+    """
+    Generate the MP3, JSON, LRC, and TXT files of a single track.
 
-        # Save Lyrics as TXT
-        with open(txt_filename, "w") as txt_file:
-            txt_file.write(txt_lyrics)
+    Args:
+        track (dict): The track entry, with its metadata and SSML queries.
+        selected_voice (dict): Selected voice options including language, name, and type.
+        output_dir (str): The directory to output the track files.
+        polly: The boto3 Polly client to use.
+        cache_dir (str): Directory to cache Polly responses in, or None to always call Polly.
+        s3_bucket (str): S3 bucket to synthesize long tracks through with asynchronous tasks, or None to call Polly directly.
+        s3: The boto3 S3 client to read task output with, needed when s3_bucket is given.
+        io_executor (ThreadPoolExecutor): Executor to write the JSON, LRC, and TXT files on, or None to write them directly.
 
-        # Add ID3 tags to the MP3 file
-        add_id3_tags(output_filename, track_metadata)
+    Returns:
+        Future: The pending write of the JSON, LRC, and TXT files, or None if they were written directly.
+    """
+    engine = selected_voice["type"]
+    voiceID = selected_voice["name"]
+
+    track_number = track["metadata"]["track"]
+    track_title = track["metadata"]["title"]
+    base_filename = f"{track_number} - {track_title}"
+
+    output_filename = os.path.join(output_dir, f"{base_filename}.mp3")
+    ssml_json_filename = os.path.join(output_dir, f"{base_filename}.json")
+    lrc_filename = os.path.join(output_dir, f"{base_filename}.lrc")
+    txt_filename = os.path.join(output_dir, f"{base_filename}.txt")
+
+    # Only long tracks are worth the extra latency of asynchronous tasks
+    if s3_bucket and sum(len(query) for query in track["ssml_queries"]) <= _TASK_MIN_CHARS:
+        s3_bucket = None
+
+    track_metadata = track["metadata"]
+    result = readEntryWithPolly(track, output_filename, voiceID, engine, track_metadata, polly, cache_dir, s3_bucket, s3)
+    sidecars = (
+        base_filename,
+        ssml_json_filename, result["ssmlJSON"],
+        lrc_filename, result["lrc_lyrics"],
+        txt_filename, result["txt_lyrics"],
+    )
+
+    # Hand the files off so they are written while the next track waits on Polly
+    if io_executor is None:
+        _write_sidecars(*sidecars)
+        return None
+    return io_executor.submit(_write_sidecars, *sidecars)
 
-        print(f"Generated MP3, JSON, LRC, and TXT files for track {track_number} - {track_title}.")
+def process_ssml_queries(ssml_queries, selected_voice, output_dir, polly, cache_dir=None, s3_bucket=None, s3=None):
+    if not ssml_queries:
+        return
+
+    # Tracks are independent of each other, so they are rendered in parallel, with their
+    # JSON, LRC, and TXT files written on a separate pool so disk writes never hold up Polly
+    with ThreadPoolExecutor(max_workers=_IO_WORKERS) as io_executor:
+        with ThreadPoolExecutor(max_workers=min(_TRACK_WORKERS, len(ssml_queries))) as executor:
+            renders = [
+                executor.submit(_render_track, track, selected_voice, output_dir, polly, cache_dir, s3_bucket, s3, io_executor)
+                for track in ssml_queries
+            ]
+            try:
+                sidecar_writes = [render.result() for render in renders]
+            except BaseException:
+                # Don't start the queued tracks once one has failed
+                executor.shutdown(wait=False, cancel_futures=True)
+                raise
+
+        # Surface any error from the writes
+        for sidecar_write in sidecar_writes:
+            sidecar_write.result()
 
 def create_preview_ssml_query(ssml_queries):
     """
@@ -359,26 +842,21 @@ def create_preview_ssml_query(ssml_queries):
         ssml_queries (list): List of SSML entries from the JSON file.
 
     Returns:
-        dict: The SSML query entry that is the longest.
+        dict: The SSML query entry that is the longest, or None if there are no queries.
     """
-    # Extract the longest SSML query entry
-    longest_query_entry = max(
-        (query for track in ssml_queries["tracklist"] for query in track["ssml_queries"]),
-        key=lambda query: len(query)
-    )
+    # Extract the longest SSML query entry along with the track it came from
+    queries = [(track, query) for track in ssml_queries for query in track["ssml_queries"]]
+    if not queries:
+        return None
+    track, longest_query_entry = max(queries, key=lambda track_query: len(track_query[1]))
 
     # Replicate the original structure for the preview entry
-    for track in ssml_queries["tracklist"]:
-        if longest_query_entry in track["ssml_queries"]:
-            preview_entry = {
-                "metadata": track["metadata"],
-                "ssml_queries": [longest_query_entry]
-            }
-            return preview_entry
-
-    return None
+    return {
+        "metadata": track["metadata"],
+        "ssml_queries": [longest_query_entry]
+    }
 
-def generate_preview(preview_entry, selected_voice, output_dir):
+def generate_preview(preview_entry, selected_voice, output_dir, polly, cache_dir=None):
     """
     Generate an MP3 preview for the longest SSML query.
 
@@ -386,10 +864,12 @@ def generate_preview(preview_entry, selected_voice, output_dir):
         preview_entry (dict): The SSML query entry to preview.
         selected_voice (dict): Selected voice options including language, name, and type.
         output_dir (str): The directory to output the preview MP3 file.
+        polly: The boto3 Polly client to use.
+        cache_dir (str): Directory to cache Polly responses in, or None to always call Polly.
     """
     preview_filename = f"{output_dir}/preview_{selected_voice['language']}_{selected_voice['name']}_{selected_voice['type']}.mp3"
-    readEntryWithPolly(preview_entry, preview_filename, selected_voice['name'], selected_voice['type'], preview_entry["metadata"])
-    print(f"Preview generated: {preview_filename}")
+    readEntryWithPolly(preview_entry, preview_filename, selected_voice['name'], selected_voice['type'], preview_entry["metadata"], polly, cache_dir)
+    logger.info("Preview generated: %s", preview_filename)
 
 def main():
     available_languages = list(polly_voices.keys())
@@ -402,9 +882,26 @@ def main():
     parser.add_argument('--voice_type', type=str, choices=["standard", "neural", "long-form", "generative"], default="neural", help="Voice type (e.g., standard, neural, long-form, generative)")
     parser.add_argument('--confirm_cost', action='store_true', help="Confirm the cost before proceeding")
     parser.add_argument('--preview_voice', action='store_true', help="Generate a preview of the longest SSML query")
+    parser.add_argument('--cache_dir', type=str, default=_DEFAULT_CACHE_DIR, help=f"Directory to cache Polly responses in, so re-runs skip unchanged pieces (default: {_DEFAULT_CACHE_DIR})")
+    parser.add_argument('--no_cache', action='store_true', help="Always call Polly, without reading or writing the response cache")
+    parser.add_argument('--verbose', action='store_true', help="Log the progress of every piece and the length of every query")
+    parser.add_argument('--s3_bucket', type=str, default=None, help=f"S3 bucket to synthesize long tracks through with asynchronous Polly tasks, written under {_TASK_KEY_PREFIX} and deleted once read, so the credentials need s3:GetObject and s3:DeleteObject on it (the preview always uses direct requests)")
 
     args = parser.parse_args()
 
+    logging.basicConfig(
+        level=logging.DEBUG if args.verbose else logging.INFO,
+        format="%(asctime)s %(levelname)s %(message)s",
+        handlers=[logging.StreamHandler()],
+    )
+    # Keep the AWS SDK's own debug output out of the verbose log
+    logging.getLogger("botocore").setLevel(logging.WARNING)
+    logging.getLogger("urllib3").setLevel(logging.WARNING)
+
+    cache_dir = None
+    if not args.no_cache:
+        cache_dir = args.cache_dir
+
     selected_voice = {
         "language": args.voice_language,
         "name": args.voice_name,
@@ -414,12 +911,13 @@ def main():
     with open(args.ssml_file, 'r') as f:
         ssml_queries = json.load(f)["tracklist"]
 
-    # Calculate cost
-    total_cost = calculate_cost(ssml_queries, selected_voice)
-
     if args.preview_voice:
         preview_entry = create_preview_ssml_query(ssml_queries)
-        preview_cost = calculate_cost([preview_entry["ssml_queries"][0]], selected_voice, verbose=args.confirm_cost)
+        if preview_entry is None:
+            logger.error("No SSML queries to preview.")
+            sys.exit(-1)
+
+        preview_cost = calculate_cost([preview_entry], selected_voice, verbose=args.confirm_cost)
         
         if args.confirm_cost:
             print(f"Estimated cost for the preview: ${preview_cost:.2f}")
@@ -428,9 +926,17 @@ def main():
                 print("Preview operation cancelled.")
                 sys.exit(0)
 
-        generate_preview(preview_entry, selected_voice, args.output_dir)
+        polly, _ = _create_clients()
+        try:
+            generate_preview(preview_entry, selected_voice, args.output_dir, polly, cache_dir)
+        except (BotoCoreError, ClientError, IOError) as error:
+            logger.error("Error: %s", error)
+            sys.exit(-1)
         sys.exit(0)
 
+    # Calculate cost
+    total_cost = calculate_cost(ssml_queries, selected_voice)
+
     if args.confirm_cost:
         print(f"Estimated total cost: ${total_cost:.2f}")
         confirm = input("Do you want to proceed? (yes/no): ").strip().lower()
@@ -439,7 +945,12 @@ def main():
             sys.exit(0)
 
     # Process SSML queries and generate MP3 and JSON files
-    process_ssml_queries(ssml_queries, selected_voice, args.output_dir)
+    polly, s3 = _create_clients(with_s3=bool(args.s3_bucket))
+    try:
+        process_ssml_queries(ssml_queries, selected_voice, args.output_dir, polly, cache_dir, args.s3_bucket, s3)
+    except (BotoCoreError, ClientError, IOError) as error:
+        logger.error("Error: %s", error)
+        sys.exit(-1)
 
 if __name__ == "__main__":
     main()
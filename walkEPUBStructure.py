@@ -1,21 +1,101 @@
 #!/usr/bin/env python3
 
 import argparse
+import hashlib
+import logging
 import os.path
+import posixpath
+import sys
+import tempfile
+import threading
 import zipfile
 import pprint
 from lxml import etree
 import xml.dom.minidom
-from io import StringIO
-import copy
+from io import StringIO, BytesIO
 import re
 import math
-from shutil import copyfile
+from shutil import copyfile, copyfileobj
+from urllib.parse import unquote
+from pathlib import Path
 import json
+import orjson
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from boto3 import Session
+from botocore.config import Config
 from botocore.exceptions import BotoCoreError, ClientError
 from contextlib import closing
-import eyed3
+from mutagen.id3 import ID3, TALB, TCON, TIT2, TPE1, TPE2, TRCK
+
+logger = logging.getLogger(__name__)
+
+# Buffer size used when copying Polly's streams
+COPY_BUFFER_SIZE = 1024*1024
+
+# The Polly engine every piece is read with
+POLLY_ENGINE = "standard"
+
+# Where Polly's responses are cached by default. This is the same cache, laid out the same way, as readSSML.py's, so
+# either script can reuse the other's responses
+DEFAULT_CACHE_DIR = os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), "tts_epub")
+
+# Number of SSML pieces (each an audio and a speech marks request) in flight with Polly at once
+POLLY_PIECE_WINDOW = 8
+
+# Number of chapters read with Polly and written out at once, each with its own window of pieces
+CHAPTER_WORKERS = 4
+
+# Number of image files copied into the output folder at once
+IMAGE_COPY_WORKERS = 8
+
+# Shared parser for the EPUB's data files (container, package document, NCX). Pages are parsed
+# separately, since dropping blank text there would join words
+XML_PARSER = etree.XMLParser(remove_comments=True, remove_blank_text=True, collect_ids=False, huge_tree=True)
+
+# lxml parsers can't be shared between threads, so each thread parsing the manifest gets its own copy
+parserLocal = threading.local()
+
+# Every src and href attribute under an element, whatever their namespace
+IMAGE_REF_XPATH = etree.XPath(".//@*[local-name()='src' or local-name()='href']")
+
+# The container's rootfiles, the NCX's navPoints and their labels, and a page's body, whatever their namespace
+ROOTFILE_XPATH = etree.XPath("./*[local-name()='rootfiles']/*[local-name()='rootfile']")
+NAVPOINT_XPATH = etree.XPath("./*[local-name()='navMap']/*[local-name()='navPoint']")
+NAVLABEL_XPATH = etree.XPath("./*[local-name()='navLabel']")
+BODY_XPATH = etree.XPath("./*[local-name()='body']")
+
+# The ID3 frame each of an entry's metaTags is written to
+ID3_FRAMES = (
+	("ARTIST", TPE1),
+	("ALBUM", TALB),
+	("ALBUMARTIST", TPE2),
+	("TITLE", TIT2),
+	("TRACK", TRCK),
+)
+
+# The whitespace after the end of a sentence (grouped, so any closing quotes or brackets stay with the sentence),
+# any run of whitespace, and a four digit year
+SENTENCE_END_RE = re.compile(r"(?<=[.!?])[\"'\u201d\u2019)\]]*(\s+)")
+WHITESPACE_RE = re.compile(r"\s+")
+YEAR_RE = re.compile(r"([1-2][0-9][0-9][0-9])")
+
+# Characters that can't go into the SSML as they are, and what they are read as instead
+SSML_CLEAN_TABLE = str.maketrans({
+	"(": " ",
+	")": " ",
+	"/": " ",
+	"\\": " ",
+	":": " ",
+	"<": " ",
+	">": " ",
+	"=": "equals",
+	"&": " and ",
+	"\u201c": "\"",
+	"\u201d": "\"",
+	"\r": None,
+	"\n": None,
+})
 
 epubZipPathList = 	[
 						"META-INF/container.xml",
@@ -89,30 +169,30 @@ def validateEPUBZip(epub_zip_file):
 			error = ValueError("EPUB zipfile missing file, see std.out")
 			errorOut(errorString, error)
 
-def eTree2childrenDataDict(etree):
+def eTree2childrenDataDict(parentETree):
 	etreeDict = {}
 	etreeIDsDict = {}
 
-	for child in etree.getchildren():
+	for child in parentETree:
 		## Continue if the element is a comment:
+		if not isinstance(child.tag, str):
+			continue
 
-		_, _, ctag = str(child.tag).rpartition('}')
+		ctag = etree.QName(child).localname
 		if ctag not in etreeDict:
 			etreeDict[ctag] = []
-		cattrib = copy.deepcopy(child.attrib)
-		newcattrib = {}
-		for key, value in cattrib.items():
-			_, _, newKey = key.rpartition('}')
-			if newKey != key:
-				newcattrib[newKey] = value
-			else:
-				newcattrib[key] = value
 
-		childText = ''.join(child.itertext()).encode('ascii', 'ignore').decode('ascii').strip()
+		# Attribute values are plain strings, so only the namespaces need stripping from the keys
+		newcattrib = {key.rpartition('}')[2]: value for key, value in child.attrib.items()}
+
+		childText = ''.join(child.itertext())
+		if not childText.isascii():
+			childText = childText.encode('ascii', 'ignore').decode('ascii')
+		childText = childText.strip()
 		if childText:
 			newcattrib["text"] = childText
 		elif child.text:
-			newcattrib["text"] = copy.deepcopy(child.text)
+			newcattrib["text"] = child.text
 
 		if "id" in newcattrib:
 			etreeIDsDict[newcattrib["id"]] = newcattrib
@@ -146,12 +226,66 @@ def applyManifestMetaRefines(metadataDict, metadataIDsDict):
 
 		metadataDict.pop("meta")
 
+def parseXHTMLBody(xmlFile):
+	# Only the body of a page is ever read, so the head is dropped as soon as the body has been parsed
+	# Blank text is kept in pages, where it can be the only space between two inline elements
+	context = etree.iterparse(xmlFile, events=("end",), tag="{*}body", remove_comments=True, collect_ids=False, huge_tree=True)
+	for _, body in context:
+		for previousElement in list(body.itersiblings(preceding=True)):
+			body.getparent().remove(previousElement)
+		return body.getroottree().getroot()
+
+	# No body, so hand back the whole page
+	return context.root
+
+def parseOPFSections(opfFile):
+	# Pick out the metadata, manifest and spine in the same pass that parses the package document
+	opfSections = {}
+	context = etree.iterparse(opfFile, events=("end",), tag=("{*}metadata", "{*}manifest", "{*}spine"), remove_comments=True, remove_blank_text=True, collect_ids=False, huge_tree=True)
+	for _, element in context:
+		if element.getparent() is not None and element.getparent().getparent() is None:
+			opfSections.setdefault(etree.QName(element).localname, element)
+
+	return context.root, opfSections
+
+def getXMLParser():
+	if not hasattr(parserLocal, "parser"):
+		parserLocal.parser = XML_PARSER.copy()
+	return parserLocal.parser
+
+def parseXMLFile(xmlFile, mediaType):
+	if mediaType == "application/xhtml+xml":
+		return parseXHTMLBody(xmlFile)
+	return etree.parse(xmlFile, parser = getXMLParser()).getroot()
+
+def parseZipXMLFile(zipfile_obj, fileName, mediaType):
+	# Parse straight from the zip, only reading the file into memory to strip anything
+	# in front of the first tag if lxml can't parse it as it is
+	try:
+		with zipfile_obj.open(fileName) as xmlFile:
+			return parseXMLFile(xmlFile, mediaType)
+	except etree.XMLSyntaxError:
+		asText = zipfile_obj.read(fileName)
+		asText = asText[asText.index(b'<'):]
+
+		try:
+			return parseXMLFile(BytesIO(asText), mediaType)
+		except etree.XMLSyntaxError as err:
+			print("~~~~~~~~~~~~~~~~~~~~~~~~~~~~")
+			print("XML PARSING ERROR!")
+			print(fileName + ":")
+			print(str(asText))
+			print("~~~~~~~~~~~~~~~~~~~~~~~~~~~~")
+			raise err
+
+def parseZipXMLBatch(zipFileName, xmlFiles):
+	# Each worker reads through its own handle on the zip, so the entries are read independently
+	with zipfile.ZipFile(zipFileName) as zipfile_obj:
+		return [parseZipXMLFile(zipfile_obj, fileName, mediaType) for fileName, mediaType in xmlFiles]
+
 def loadManifest(manifestDict, loadedEPUBFileDict, zipfile_obj):
-	parser =  etree.XMLParser(remove_comments=True)
 	fileName = None
 
-	pp = pprint.PrettyPrinter(indent=4)
-
 	pathHeader = "OEBPS"
 	pathHeader_alt = "OPS"
 	
@@ -159,43 +293,38 @@ def loadManifest(manifestDict, loadedEPUBFileDict, zipfile_obj):
 	# print(zipfile_obj.namelist())
 
 	extractedImageLocations = {}
+	imageFileNames = []
+	xmlFiles = []
+	unzipPath = os.path.join("/tmp","epub")
+
+	zipNameSet = set(zipfile_obj.namelist())
 
 	for item in manifestDict["item"]:
 		mediaType = item["media-type"]
 
-		if item["href"] in zipfile_obj.namelist():
-			fileName = item["href"]
-		elif os.path.join(pathHeader,item["href"]) in zipfile_obj.namelist():
-			fileName = os.path.join(pathHeader,item["href"])
-		elif os.path.join(pathHeader_alt,item["href"]) in zipfile_obj.namelist():
-			fileName = os.path.join(pathHeader_alt,item["href"])
+		# Zip entry names always use '/', whatever the platform
+		href = item["href"]
+		headerHREF = pathHeader + "/" + href
+		headerHREF_alt = pathHeader_alt + "/" + href
+		if href in zipNameSet:
+			fileName = href
+		elif headerHREF in zipNameSet:
+			fileName = headerHREF
+		elif headerHREF_alt in zipNameSet:
+			fileName = headerHREF_alt
 		else:
-			stringError = "Unable to find the relevent reference\nReference:\n" + str(item["href"]) + "\n\nZipfile's Namelist:\n" + str("\n".join(zipfile_obj.namelist()))
+			stringError = "Unable to find the relevent reference\nReference:\n" + str(href) + "\n\nZipfile's Namelist:\n" + str("\n".join(zipfile_obj.namelist()))
 			errorOut(stringError, ValueError("Manifest had mis-referenced location"))
 		itemID = item["id"]
 
 		if "xml" in mediaType:
-			asText = zipfile_obj.read(fileName)
-			asText = asText[asText.index(b'<'):]
-			
-			try:
-				loadedEtree = etree.fromstring(asText, parser = parser)
-			except etree.XMLSyntaxError as err:
-				print("~~~~~~~~~~~~~~~~~~~~~~~~~~~~")
-				print("XML PARSING ERROR!")
-				print(fileName + ":")
-				print(str(asText))
-				print("~~~~~~~~~~~~~~~~~~~~~~~~~~~~")
-				raise err
-
-			loadedEPUBFileDict[fileName] = loadedEtree
+			xmlFiles.append((fileName, mediaType))
 			item["xml"] = fileName
 			# item["txt"] = asText
 		elif "image" in mediaType:
-			unzipPath = os.path.join("/tmp","epub")
-			unzipPath_full = os.path.join("/tmp","epub",fileName)
-			zipfile_obj.extract(fileName, path=unzipPath)
-			extractedImageLocations[item["href"]] = unzipPath_full
+			unzipPath_full = os.path.join(unzipPath,fileName)
+			imageFileNames.append(fileName)
+			extractedImageLocations[href] = unzipPath_full
 		elif "text" in mediaType:
 			# item["txt"] = zipfile_obj.read(fileName)
 			pass
@@ -204,9 +333,39 @@ def loadManifest(manifestDict, loadedEPUBFileDict, zipfile_obj):
 			# print("NOT: " + str(item))
 			# print(fileName)
 
+	# Parse the XML files across the cores, each worker taking every workerCount'th file, then
+	# add them to the dict in manifest order
+	workerCount = min(os.cpu_count() or 1, len(xmlFiles))
+	if workerCount > 1 and zipfile_obj.filename:
+		parsedETrees = [None] * len(xmlFiles)
+		with ThreadPoolExecutor(max_workers=workerCount) as executor:
+			batchFutures = [executor.submit(parseZipXMLBatch, zipfile_obj.filename, xmlFiles[workerIndex::workerCount]) for workerIndex in range(workerCount)]
+			for workerIndex, batchFuture in enumerate(batchFutures):
+				parsedETrees[workerIndex::workerCount] = batchFuture.result()
+	else:
+		parsedETrees = [parseZipXMLFile(zipfile_obj, fileName, mediaType) for fileName, mediaType in xmlFiles]
+
+	for (fileName, _), loadedEtree in zip(xmlFiles, parsedETrees):
+		loadedEPUBFileDict[fileName] = loadedEtree
+
+	# Extract all the images together once their names are known
+	if imageFileNames:
+		zipfile_obj.extractall(path=unzipPath, members=imageFileNames)
+
 	return extractedImageLocations
 
-def findRefInEPUB(refString,loadedEPUBFileDict):
+def buildRefIndex(loadedEPUBFileDict):
+	# Map every trailing part of each loaded path ("OEBPS/text/a.xhtml", "text/a.xhtml", "a.xhtml") to the
+	# first path it belongs to, so references can be looked up without scanning every file
+	refIndex = {}
+	for key in loadedEPUBFileDict:
+		pathParts = key.split("/")
+		for partIndex in range(len(pathParts)):
+			refIndex.setdefault("/".join(pathParts[partIndex:]), key)
+
+	return refIndex
+
+def findRefInEPUB(refString,loadedEPUBFileDict, refIndex=None):
 	if "../" in refString:
 		refString = refString.replace("../","")
 	if "./" in refString:
@@ -214,6 +373,9 @@ def findRefInEPUB(refString,loadedEPUBFileDict):
 
 	refString = refString.split("#", 1)[0]
 
+	if refIndex and refString in refIndex:
+		return refIndex[refString]
+
 	# print(refString)
 	for key, value in loadedEPUBFileDict.items():
 		if refString in key:
@@ -221,10 +383,6 @@ def findRefInEPUB(refString,loadedEPUBFileDict):
 			return key
 
 def readInitialEPUBFiles(zipfile_obj, ignoreTOC = False):
-	parser =  etree.XMLParser(remove_comments=True)
-
-	pp = pprint.PrettyPrinter(indent=4)
-
 	loadedEPUBFileDict = {}
 	for path in epubZipPathList:
 		loadedEPUBFileDict[path] = zipfile_obj.read(path)
@@ -235,41 +393,39 @@ def readInitialEPUBFiles(zipfile_obj, ignoreTOC = False):
 			error = ValueError("EPUB Zip has incorrect mimetype")
 			errorOut(errorString, error)
 
-	loadedEPUBFileDict["META-INF/container.xml"] = etree.fromstring(loadedEPUBFileDict["META-INF/container.xml"], parser = parser)
+	loadedEPUBFileDict["META-INF/container.xml"] = etree.fromstring(loadedEPUBFileDict["META-INF/container.xml"], parser = XML_PARSER)
 	
 	
 	contentOPF_location = None
-	rootfile_locations = loadedEPUBFileDict["META-INF/container.xml"].findall("./rootfiles/rootfile",loadedEPUBFileDict["META-INF/container.xml"].nsmap)
+	rootfile_locations = ROOTFILE_XPATH(loadedEPUBFileDict["META-INF/container.xml"])
 	for rootFileElement in rootfile_locations:
 		rootFilePath = rootFileElement.attrib["full-path"]
-		loadedEPUBFileDict[rootFilePath] = etree.fromstring(zipfile_obj.read(rootFilePath), parser = parser)
 		
 		if ".opf" in rootFilePath.lower():
+			loadedEPUBFileDict[rootFilePath], opfSections = parseOPFSections(BytesIO(zipfile_obj.read(rootFilePath)))
 			contentOPF_location = rootFilePath
+		else:
+			loadedEPUBFileDict[rootFilePath] = etree.fromstring(zipfile_obj.read(rootFilePath), parser = XML_PARSER)
 
 	if contentOPF_location:
-		contentETree = loadedEPUBFileDict[contentOPF_location]
-
-		metadataETree =	contentETree.find("./metadata",contentETree.nsmap)
+		metadataETree =	opfSections.get("metadata")
 		print("Reading metadata")
 		metadataDict, metadataIDsDict =  eTree2childrenDataDict(metadataETree)
 		applyManifestMetaRefines(metadataDict, metadataIDsDict)
 		
-		manifestETree =	contentETree.find("./manifest",contentETree.nsmap)
+		manifestETree =	opfSections.get("manifest")
 		print("Reading manifest")
 		manifestDict, manifestIDsDict =  eTree2childrenDataDict(manifestETree)
 		extractedImageLocations = loadManifest(manifestDict, loadedEPUBFileDict, zipfile_obj)
+		refIndex = buildRefIndex(loadedEPUBFileDict)
 		print("Reading spine")
-		spineETree = 	contentETree.find("./spine",contentETree.nsmap)
+		spineETree = 	opfSections.get("spine")
 		spineDict, spineIDsDict =  eTree2childrenDataDict(spineETree)
 
-		print("Manifest: ")
-		pp.pprint(manifestIDsDict)
-
-		print()
-
-		print("Spine Dict: ")
-		pp.pprint(spineDict)
+		# Only format the (large) manifest and spine when they will actually be logged
+		if logger.isEnabledFor(logging.DEBUG):
+			logger.debug("Manifest:\n%s", pprint.pformat(manifestIDsDict, indent=4))
+			logger.debug("Spine Dict:\n%s", pprint.pformat(spineDict, indent=4))
 
 		# zipfile_obj.printdir()
 
@@ -291,16 +447,17 @@ def readInitialEPUBFiles(zipfile_obj, ignoreTOC = False):
 
 		if ncxTag:
 			ncxETree = loadedEPUBFileDict[manifestIDsDict[ncxTag]["xml"]]
-			ncxETree_navMap = ncxETree.findall("./navMap/navPoint",ncxETree.nsmap)
+			ncxETree_navMap = NAVPOINT_XPATH(ncxETree)
 			navPointList = []
 			for navPoint in ncxETree_navMap:
 				navPointDict, navPointIDsDict =  eTree2childrenDataDict(navPoint)
 				# print(navPointDict)
-				navPointDict["content"][0]["src"] = findRefInEPUB(navPointDict["content"][0]["src"],loadedEPUBFileDict)
-				navLabelETree = navPoint.find("./navLabel",navPoint.nsmap)
+				contentDict = navPointDict["content"][0]
+				contentDict["src"] = findRefInEPUB(contentDict["src"],loadedEPUBFileDict, refIndex)
+				navLabelETree = NAVLABEL_XPATH(navPoint)[0]
 				navLabelDict, _ =  eTree2childrenDataDict(navLabelETree)
 				navPointDict["text"] = navLabelDict["text"][0]["text"]
-				navPointDict["src"] = navPointDict["content"][0]["src"]
+				navPointDict["src"] = contentDict["src"]
 				# print(navPointDict["content"])
 				navPointDict.pop("navLabel")
 				navPointDict.pop("content")
@@ -311,48 +468,47 @@ def readInitialEPUBFiles(zipfile_obj, ignoreTOC = False):
 
 		entryList = None
 		if ncxDict and not ignoreTOC:
-			pp.pprint(ncxDict)
-			if len(ncxDict["navMap"]) > 1:
+			if logger.isEnabledFor(logging.DEBUG):
+				logger.debug("NCX Dict:\n%s", pprint.pformat(ncxDict, indent=4))
+			navMap = ncxDict["navMap"]
+			if len(navMap) > 1:
+				# Index the navMap by each chapter's file (without its fragment), so every spine item can be
+				# checked for the start of a chapter with one lookup
+				navIndex = {}
+				for navPointIndex, navPoint in enumerate(navMap):
+					if navPoint["src"] is not None:
+						navIndex.setdefault(navPoint["src"].split("#", 1)[0], navPointIndex)
+
 				entryList = []
 				targetXMLList = []
 				nextEntryIndex = 0
-				targetEntryStart = ncxDict["navMap"][nextEntryIndex]
-				# print(targetEntryStart)
-				pp.pprint(spineDict)
 				for item in spineDict["itemref"]:
-					item["href"] = findRefInEPUB(item["href"],loadedEPUBFileDict)
-					if targetEntryStart["src"] is None:
-						continue
-					ncxSrc = targetEntryStart["src"].split("#", 1)[0]
-					# print(ncxSrc)
-					if item["href"] == ncxSrc:
-						if targetEntryStart:
-							entryList.append({\
-								"index": nextEntryIndex,
-								"text": targetEntryStart["text"],
-								"xml": None,
-							})
-
-						prevEntryStart = targetEntryStart
-						while nextEntryIndex < len(ncxDict["navMap"])-1 and prevEntryStart["src"].split("#", 1)[0] == targetEntryStart["src"].split("#", 1)[0]:
-							nextEntryIndex += 1
-							targetEntryStart = ncxDict["navMap"][nextEntryIndex]
+					item["href"] = findRefInEPUB(item["href"],loadedEPUBFileDict, refIndex)
+					chapterIndex = navIndex.get(item["href"])
+					# Chapters only start going forward through the navMap
+					if chapterIndex is not None and chapterIndex >= nextEntryIndex:
+						entryList.append({\
+							"index": chapterIndex,
+							"text": navMap[chapterIndex]["text"],
+							"xml": None,
+						})
+						nextEntryIndex = chapterIndex + 1
+
 						if len(entryList) > 1:
-							entryList[len(entryList)-2]["xml"] = targetXMLList
+							entryList[-2]["xml"] = targetXMLList
 						targetXMLList = []
 
 					targetXMLList.append(item["xml"])
-				entryList[len(entryList)-1]["xml"] = targetXMLList
+				entryList[-1]["xml"] = targetXMLList
 			else:
 				print("BAD ncxDict...doing each xml as an entry?")
 				entryList = []
 				targetXMLList = []
 				nextEntryIndex = 0
-				targetEntryStart = ncxDict["navMap"][nextEntryIndex]
+				targetEntryStart = navMap[nextEntryIndex]
 				# print(targetEntryStart)
-				pp.pprint(spineDict)
 				for item in spineDict["itemref"]:
-					item["href"] = findRefInEPUB(item["href"],loadedEPUBFileDict)
+					item["href"] = findRefInEPUB(item["href"],loadedEPUBFileDict, refIndex)
 					entryList.append({\
 						"index": nextEntryIndex,
 						"text": targetEntryStart["text"],
@@ -404,7 +560,6 @@ def readInitialEPUBFiles(zipfile_obj, ignoreTOC = False):
 	return loadedEPUBFileDict, extractedImageLocations, metadataDict, entryList
 
 def applyEPUBMetaTags(metadataDict, entryList):
-	pp = pprint.PrettyPrinter(indent=4)
 	### Examples from https://github.com/seanap/Plex-Audiobook-Guide
 	# TIT1 (CONTENTGROUP) 	Series, Book #
 	# TALB (ALBUM) 	Title
@@ -448,21 +603,8 @@ def applyEPUBMetaTags(metadataDict, entryList):
 	if "creator" in metadataDict:
 		creatorBlockList = metadataDict["creator"]
 		if len(creatorBlockList) > 1:
-			# Order Creators:
-			toReorder = list(range(len(creatorBlockList)))
-			while toReorder:
-				currentIndex = toReorder[0]
-				moveTo = None
-				if "display-seq" in creatorBlockList[currentIndex]:
-					moveTo = int(creatorBlockList[currentIndex]["display-seq"]) - 1
-					copyCreator = creatorBlockList[moveTo]
-					creatorBlockList[moveTo] = creatorBlockList[currentIndex]
-					creatorBlockList[currentIndex] = copyCreator
-
-				if not moveTo:
-					toReorder.pop(toReorder.index(currentIndex))
-				elif moveTo in toReorder:
-					toReorder.pop(toReorder.index(moveTo))
+			# Order Creators, any without a display-seq keep their order after those with one:
+			creatorBlockList.sort(key=lambda creator: int(creator["display-seq"]) if "display-seq" in creator else math.inf)
 
 			# Find creator assignment
 			for creator in creatorBlockList:
@@ -507,16 +649,16 @@ def applyEPUBMetaTags(metadataDict, entryList):
 			for dateBlock in dateBlockList:
 				if "event" in dateBlock:
 					if "publication" in dateBlock["event"]:
-						yearMatch = re.findall(r"([1-2][0-9][0-9][0-9])",dateBlock["text"])
+						yearMatch = YEAR_RE.search(dateBlock["text"])
 						if yearMatch:
-							albumMetaTags["YEAR"] = yearMatch[0]
+							albumMetaTags["YEAR"] = yearMatch.group(1)
 				if "YEAR" in albumMetaTags:
 					break
 		else:
 			dateBlock = dateBlockList[0]
-			yearMatch = re.findall(r"([1-2][0-9][0-9][0-9])",dateBlock["text"])
+			yearMatch = YEAR_RE.search(dateBlock["text"])
 			if yearMatch:
-				albumMetaTags["YEAR"] = yearMatch[0]
+				albumMetaTags["YEAR"] = yearMatch.group(1)
 
 	# Apply copyright based information
 	if "rights" in metadataDict:
@@ -527,9 +669,9 @@ def applyEPUBMetaTags(metadataDict, entryList):
 			albumMetaTags["COPYRIGHT"] = rightsBlock["text"]
 
 		if "YEAR" not in albumMetaTags and "COPYRIGHT" in albumMetaTags and albumMetaTags["COPYRIGHT"]:
-			yearMatch = re.findall(r"([1-2][0-9][0-9][0-9])",albumMetaTags["COPYRIGHT"])
+			yearMatch = YEAR_RE.search(albumMetaTags["COPYRIGHT"])
 			if yearMatch:
-				albumMetaTags["YEAR"] = yearMatch[0]
+				albumMetaTags["YEAR"] = yearMatch.group(1)
 
 	# Apply title based information
 	if "title" in metadataDict:
@@ -561,11 +703,16 @@ def applyEPUBMetaTags(metadataDict, entryList):
 	# pp.pprint(entryList)
 	# print()
 
+	# The album tags are all strings apart from the genre list, so each entry only needs its own
+	# copy of the dict and of that list
+	genreList = albumMetaTags.get("TMP_GENREX")
 	for entryIndex in range(len(entryList)):
 		entry = entryList[entryIndex]
 
-		entry["metaTags"] = copy.deepcopy(albumMetaTags)
-		metaTags = entry["metaTags"]
+		metaTags = dict(albumMetaTags)
+		if genreList:
+			metaTags["TMP_GENREX"] = genreList.copy()
+		entry["metaTags"] = metaTags
 
 		if "text" in entry and entry["text"] != None:
 			metaTags["TITLE"] = cleanMetaEntry(entry["text"])
@@ -579,68 +726,92 @@ def applyEPUBMetaTags(metadataDict, entryList):
 	return entryList
 
 def collapse2PTextList(ETreeElement, useDiv=False):
-	pp = pprint.PrettyPrinter(indent=4)
 	paragraphList = []
-	singleTagList = [	"p",
+	singleTagSet = {	"p",
 						"h1",
 						"h2",
 						"h3",
 						"h4",
-					]
+					}
 
 	if useDiv:
-		singleTagList.append("div")
-
-	paragraphList.append(''.join(ETreeElement.itertext()).encode('ascii', 'ignore').decode('ascii'))
-
-	_, _, cleanedTag = ETreeElement.tag.rpartition('}')
-	isSingleTag = cleanedTag in singleTagList
-	# print(cleanedTag + " - " + str(isSingleTag))
-
-	if not isSingleTag:
-		for childElement in ETreeElement.getchildren():
-			childList = collapse2PTextList(childElement, useDiv=useDiv)
-
-			childrenToRemove = []
-			for childIndex in range(len(childList)):
-				childText = childList[childIndex]
-				if childText in paragraphList[0]:
-					childSubstringIndex = paragraphList[0].index(childText)
-					# print(childSubstringIndex)
-					# print("Before:\n" + paragraphList[0])
-					if paragraphList[0][0:childSubstringIndex] == "" or paragraphList[0][0:childSubstringIndex].isspace() or paragraphList[0][childSubstringIndex:] == "" or paragraphList[0][childSubstringIndex:].isspace():
-						paragraphList[0] = paragraphList[0].replace(childText," ",1)
-					else:
-						childrenToRemove.append(childIndex)
-					# print("After:\n" + paragraphList[0])
-					# print()
+		singleTagSet.add("div")
+
+	# Each open element that isn't a single tag collects its own text in a frame of
+	# [element, still at the start of the element, text parts]. Children met while the element
+	# has only had whitespace so far are separate paragraphs, anything after that is kept inline.
+	openFrames = []
+	walker = etree.iterwalk(ETreeElement, events=("start", "end"))
+	for event, element in walker:
+		parentFrame = openFrames[-1] if openFrames else None
+
+		if event == "start":
+			if not isinstance(element.tag, str):
+				continue
+			if parentFrame and not parentFrame[1]:
+				parentFrame[2].append(''.join(element.itertext()))
+				walker.skip_subtree()
+			elif etree.QName(element).localname in singleTagSet:
+				paragraphList.append(''.join(element.itertext()))
+				walker.skip_subtree()
+			else:
+				text = element.text or ""
+				openFrames.append([element, text.isspace() or not text, [text]])
+			continue
 
-			for childIndex in reversed(childrenToRemove):
-				childList.pop(childIndex)
+		if parentFrame and parentFrame[0] is element:
+			openFrames.pop()
+			paragraphList.append(''.join(parentFrame[2]))
+			parentFrame = openFrames[-1] if openFrames else None
 
-			paragraphList.extend(childList)
+		# The tail belongs to the enclosing element
+		if parentFrame and element.tail:
+			parentFrame[2].append(element.tail)
+			if not element.tail.isspace():
+				parentFrame[1] = False
 
-	return paragraphList
+	return [paragraph if paragraph.isascii() else paragraph.encode('ascii', 'ignore').decode('ascii') for paragraph in paragraphList]
 
 def cleanSSMLString(SSML_P_String):
-	SSML_P_String = SSML_P_String.replace("("," ")
-	SSML_P_String = SSML_P_String.replace(")"," ")
-	SSML_P_String = SSML_P_String.replace("/"," ")
-	SSML_P_String = SSML_P_String.replace("\\"," ")
-	SSML_P_String = SSML_P_String.replace(":"," ")
-	SSML_P_String = SSML_P_String.replace("<"," ")
-	SSML_P_String = SSML_P_String.replace(">"," ")
-	SSML_P_String = SSML_P_String.replace("=", "equals")
-	SSML_P_String = SSML_P_String.replace("&", " and ")
-	SSML_P_String = SSML_P_String.replace("\xe2\x80\x9c", "\"")
-	SSML_P_String = SSML_P_String.replace("\xe2\x80\x9d", "\"")
-	SSML_P_String = SSML_P_String.replace("\r\n", "")
-	SSML_P_String = SSML_P_String.replace("\n", "")
-	return SSML_P_String
+	return SSML_P_String.translate(SSML_CLEAN_TABLE)
+
+def hardSplitChunk(chunk, maxLen):
+	# For text with no sentence end to cut at, cut at the last whitespace that fits, or mid-word if there isn't any
+	chunkList = []
+	while len(chunk) > maxLen:
+		spaces = list(WHITESPACE_RE.finditer(chunk, 1, maxLen + 1))
+		if spaces:
+			chunkList.append(chunk[:spaces[-1].start()])
+			chunk = chunk[spaces[-1].end():].lstrip()
+		else:
+			chunkList.append(chunk[:maxLen])
+			chunk = chunk[maxLen:]
+	if chunk:
+		chunkList.append(chunk)
+	return chunkList
+
+def findImageREFs(body, xmlPage, extractedImageLocations):
+	# Resolve every src and href in the page (including xlink:href in SVG) against the page's own location,
+	# and match them to the manifest's image references, which are relative to the package document
+	xmlPageDir = posixpath.dirname(xmlPage)
+	foundImageREFs = set()
+	for refString in IMAGE_REF_XPATH(body):
+		refString = refString.split("#", 1)[0].split("?", 1)[0]
+		if not refString:
+			continue
+
+		# Manifest references may or may not be percent-encoded
+		for candidateREF in {refString, unquote(refString)}:
+			pathParts = posixpath.normpath(posixpath.join(xmlPageDir, candidateREF)).split("/")
+			for partIndex in range(len(pathParts)):
+				imageREF = "/".join(pathParts[partIndex:])
+				if imageREF in extractedImageLocations:
+					foundImageREFs.add(imageREF)
+					break
 
-def applyParagraphs2EntryList(entryList, loadedEPUBFileDict, extractedImageLocations, maxParLen = 2000, useDiv = False):
-	pp = pprint.PrettyPrinter(indent=4)
+	return foundImageREFs
 
+def applyParagraphs2EntryList(entryList, loadedEPUBFileDict, extractedImageLocations, maxParLen = 2000, useDiv = False):
 	for entry in entryList:
 		# pp.pprint(entry)
 		if "xml" in entry and len(entry["xml"]) > 0:
@@ -648,94 +819,45 @@ def applyParagraphs2EntryList(entryList, loadedEPUBFileDict, extractedImageLocat
 			for xmlPage in entry["xml"]:
 				if xmlPage in loadedEPUBFileDict:
 					# print(xmlPage + ":")
-					body =	loadedEPUBFileDict[xmlPage].find("./body",loadedEPUBFileDict[xmlPage].nsmap)
+					bodyList = BODY_XPATH(loadedEPUBFileDict[xmlPage])
+					body = bodyList[0] if bodyList else None
 					if not body:
 						continue
 					# print(etree.tostring(loadedEPUBFileDict[xmlPage], pretty_print=True, encoding="unicode"))
-					xmlString = etree.tostring(body, pretty_print=True, encoding="unicode")
 
-					for extractedImageREF, extractedImageLoc  in extractedImageLocations.items():
-						if extractedImageREF in xmlString:
+					if extractedImageLocations:
+						# Images are added in manifest order, once each
+						foundImageREFs = findImageREFs(body, xmlPage, extractedImageLocations)
+						if foundImageREFs:
 							if "images" not in entry:
 								entry["images"] = []
-							entry["images"].append(extractedImageLoc)
-
-					SSML_P_List = collapse2PTextList(body, useDiv=useDiv)
-
-					onlySpacesIndecies = []
-					for P_index in range(len(SSML_P_List)):
-						SSML_P_List[P_index] = SSML_P_List[P_index].replace("\n"," ")
-						if SSML_P_List[P_index].isspace():
-							onlySpacesIndecies.append(P_index)
-
-					for P_index_toRemove in reversed(onlySpacesIndecies):
-						SSML_P_List.pop(P_index_toRemove)
-
-					for P_index in range(len(SSML_P_List)):
-						SSML_P_List[P_index] = cleanSSMLString(SSML_P_List[P_index])
-
-					while None in SSML_P_List or "" in SSML_P_List or "\n" in SSML_P_List:
-						if None in SSML_P_List:
-							SSML_P_List.pop(SSML_P_List.index(None))
+							entry["images"].extend(extractedImageLoc for extractedImageREF, extractedImageLoc in extractedImageLocations.items() if extractedImageREF in foundImageREFs)
 
-						if "\n" in SSML_P_List:
-							SSML_P_List.pop(SSML_P_List.index("\n"))
-
-						if "" in SSML_P_List:
-							SSML_P_List.pop(SSML_P_List.index(""))
+					# Clean every paragraph, then drop any left empty or with only whitespace
+					SSML_P_List = [cleanSSMLString(SSML_P.replace("\n"," ")) for SSML_P in collapse2PTextList(body, useDiv=useDiv)]
+					SSML_P_List = [SSML_P for SSML_P in SSML_P_List if SSML_P and not SSML_P.isspace()]
 
 					for SSML_P in SSML_P_List:
 						if len(SSML_P) > maxParLen:
-							Original_SSML_P_dict = {"xml": xmlPage}
-							Original_SSML_P_dict["text"] = SSML_P
-							Original_SSML_P_dict["chars"] = len(Original_SSML_P_dict["text"])
-
 							targetGroups = math.ceil(len(SSML_P)/maxParLen)
 							targetSize = math.floor(len(SSML_P)/targetGroups/100)*100
-							sentenceList = re.split('\.',SSML_P)
-
-							currentParagraph = []
-							currentChars = 0
-							localParagraphList = []
-							for sentence in sentenceList:
-								currentParagraph.append(sentence + ".")
-								currentChars += len(sentence) + 1
-								if currentChars > targetSize:
-									SSML_P_dict = {"xml": xmlPage}
-									SSML_P_dict["text"] = "".join(currentParagraph)
-									SSML_P_dict["chars"] = len(SSML_P_dict["text"])
-
-									if SSML_P_dict["chars"] > maxParLen:
-										pass
-										# pp.pprint(SSML_P_dict)
-
-									paragraphList.append(SSML_P_dict)
-									localParagraphList.append(SSML_P_dict)
-
-									currentParagraph = []
-									currentChars = 0
-
-							if len(currentParagraph) > 0:
-								SSML_P_dict = {"xml": xmlPage}
-								SSML_P_dict["text"] = " ".join(currentParagraph)
-								SSML_P_dict["chars"] = len(SSML_P_dict["text"])
-
-								if SSML_P_dict["chars"] > maxParLen:
-									pass
-									# pp.pprint(SSML_P_dict)
-
-								paragraphList.append(SSML_P_dict)
-								localParagraphList.append(SSML_P_dict)
-
-								currentParagraph = []
-								currentChars = 0
-
-							# print("Original:")
-							# pp.pprint(Original_SSML_P_dict)
-							# print()
-							# print("New:")
-							# pp.pprint(localParagraphList)
-							# print("\n")
+
+							# Cut the paragraph at the first sentence end past each targetSize, slicing
+							# the chunks straight out of the paragraph
+							chunkList = []
+							chunkStart = 0
+							for sentenceEnd in SENTENCE_END_RE.finditer(SSML_P):
+								if sentenceEnd.start(1) - chunkStart >= targetSize:
+									chunkList.append(SSML_P[chunkStart:sentenceEnd.start(1)])
+									chunkStart = sentenceEnd.end(1)
+
+							if chunkStart < len(SSML_P):
+								chunkList.append(SSML_P[chunkStart:])
+
+							# Sentences too long to fit are cut at whitespace instead, so no chunk is over maxParLen
+							for chunk in chunkList:
+								for subChunk in hardSplitChunk(chunk, maxParLen):
+									paragraphList.append({"xml": xmlPage, "text": subChunk, "chars": len(subChunk)})
 
 						else:
 							SSML_P_dict = {"xml": xmlPage}
@@ -753,8 +875,6 @@ def applyParagraphs2EntryList(entryList, loadedEPUBFileDict, extractedImageLocat
 		# pp.pprint(entry)
 
 def applySSML2EntryList(entryList, maxChars = 2700):
-	pp = pprint.PrettyPrinter(indent=4)
-
 	addMarks = True
 	addBreaks= False
 	breakStrength = "x-strong"
@@ -762,75 +882,59 @@ def applySSML2EntryList(entryList, maxChars = 2700):
 	prosodyRate = "medium"
 	addEmphasis = False
 
+	# The tags opening and closing every query are the same, so they are only built once
+	speakStart = "<speak>\n"
+	if addProsody:
+		speakStart += "<prosody rate=\"" + prosodyRate + "\">\n"
+
+	speakEnd = ""
+	if addBreaks:
+		speakEnd += "<break strength=\"" + breakStrength + "\"/>\n"
+	if addMarks:
+		speakEnd += "<mark name=\"end\"/>\n"
+	if addProsody:
+		speakEnd += "</prosody>\n"
+	speakEnd += "</speak>"
 
-	
 	for entry in entryList:
 		if "paragraphs" in entry and len(entry["paragraphs"]) > 0:
 			currentChars = 0
 			paragraphIndex = 0
 			entry["ssml"] = []
 
-			currentSSML = "<speak>\n"
-			if addProsody:
-				currentSSML = currentSSML + "<prosody rate=\"" + prosodyRate + "\">\n"
+			currentSSML = StringIO()
+			currentSSML.write(speakStart)
 			for paragraph in entry["paragraphs"]:
 				paragraphLength = paragraph["chars"]
 				paragraphText = paragraph["text"]
 
-
-				paragraph["ssml"] = ""
-
 				paragraph["index"] = paragraphIndex
 
-
 				if currentChars + paragraphLength < maxChars:
-					paragraph["ssml"] += "<p>" + paragraphText + "</p>\n"
-					if addMarks:
-						paragraph["mark"] = "p" + str(paragraphIndex)
-						paragraph["ssml"] += "<mark name=\"" + paragraph["mark"] + "\"/>\n"
-						paragraphIndex += 1
-					currentSSML += paragraph["ssml"]
-
 					currentChars += paragraphLength
 
 				elif paragraphLength < maxChars:
-					if addBreaks:
-						currentSSML += "<break strength=\"" + breakStrength + "\"/>\n"
-					if addMarks:
-						currentSSML += "<mark name=\"end\"/>\n"
-					if addProsody:
-						currentSSML += "</prosody>\n"
-					currentSSML += "</speak>"
-
-					entry["ssml"].append(currentSSML)
-					currentSSML = ""
-
-					currentSSML += "<speak>\n"
-					if addProsody:
-						currentSSML += "<prosody rate=\"" + prosodyRate + "\">\n"
-					
-					
-					paragraph["ssml"] += "<p>" + paragraphText + "</p>\n"
-					if addMarks:
-						paragraph["mark"] = "p" + str(paragraphIndex)
-						paragraph["ssml"] += "<mark name=\"" + paragraph["mark"] + "\"/>\n"
-						paragraphIndex += 1
-					currentSSML += paragraph["ssml"]
+					currentSSML.write(speakEnd)
+					entry["ssml"].append(currentSSML.getvalue())
+
+					currentSSML = StringIO()
+					currentSSML.write(speakStart)
 
 					currentChars = len(paragraphText)
 				else:
 					# pp.pprint(paragraphText)
 					errorOut("Paragraph in Question:\n" +  paragraphText, ValueError("A Single Paragraph exceeds the limits of Polly (" + str(maxChars) + " chars)"))
-			if addBreaks:
-				currentSSML += "<break strength=\"" + breakStrength + "\"/>\n"
-			if addMarks:
-						currentSSML += "<mark name=\"end\"/>\n"
-			if addProsody:
-				currentSSML += "</prosody>\n"
-			currentSSML = currentSSML + "</speak>\n"
 
-			entry["ssml"].append(currentSSML)
-			currentSSML = ""
+				paragraphSSML = ["<p>", paragraphText, "</p>\n"]
+				if addMarks:
+					paragraph["mark"] = "p" + str(paragraphIndex)
+					paragraphSSML.extend(("<mark name=\"", paragraph["mark"], "\"/>\n"))
+					paragraphIndex += 1
+				paragraph["ssml"] = "".join(paragraphSSML)
+				currentSSML.write(paragraph["ssml"])
+
+			currentSSML.write(speakEnd + "\n")
+			entry["ssml"].append(currentSSML.getvalue())
 
 def getFirstImage(entryList, extractedImageLocations):
 	for entry in entryList:
@@ -890,133 +994,185 @@ def getLikelyTextChapterRange(entryList, likelyTOCEntryIndex):
 		if len(consecutiveIndexSet) > len(targetList):
 			targetList = consecutiveIndexSet
 
-	if likelyTOCEntryIndex and likelyTOCEntryIndex >= targetList[0] and likelyTOCEntryIndex < targetList[len(targetList)-1]:
-		return likelyTOCEntryIndex + 1, targetList[len(targetList)-1]
-	return targetList[0], targetList[len(targetList)-1]
+	if likelyTOCEntryIndex and likelyTOCEntryIndex >= targetList[0] and likelyTOCEntryIndex < targetList[-1]:
+		return likelyTOCEntryIndex + 1, targetList[-1]
+	return targetList[0], targetList[-1]
 
 
-def readEntryWithPolly(entry ,outfilename, voiceID):
-	session = Session() #profile_name="adminuser")
-	polly = session.client("polly")
+def getPieceCachePath(cacheDir, piece, voiceID, outputFormat):
+	# Responses are cached under their voice and engine, by a hash of the piece's SSML
+	pieceHash = hashlib.blake2b(piece.encode("utf-8")).hexdigest()
+	return os.path.join(cacheDir, voiceID, POLLY_ENGINE, pieceHash + "." + outputFormat)
 
-	print("Printing out mp3: " + outfilename + " with voiceID: " + voiceID)
+def synthesizePieceWithPolly(polly, piece, voiceID, outputFormat, cacheDir=None):
+	cachePath = None
+	if cacheDir:
+		cachePath = getPieceCachePath(cacheDir, piece, voiceID, outputFormat)
+		if os.path.exists(cachePath):
+			with open(cachePath, "rb") as cachedFile:
+				return BytesIO(cachedFile.read())
+
+	if outputFormat == "json":
+		response = polly.synthesize_speech(Text=piece, TextType="ssml", OutputFormat="json",SpeechMarkTypes=["ssml","sentence"],VoiceId=voiceID,Engine=POLLY_ENGINE)
+	else:
+		response = polly.synthesize_speech(Text=piece, TextType="ssml", OutputFormat=outputFormat,VoiceId=voiceID,Engine=POLLY_ENGINE)
+
+	if "AudioStream" not in response:
+		raise IOError("Could not stream " + outputFormat)
+
+	# Read the whole response here, so the download overlaps with the other requests in flight
+	content = BytesIO()
+	with closing(response["AudioStream"]) as stream:
+		copyfileobj(stream, content, COPY_BUFFER_SIZE)
+	content.seek(0)
+
+	if cachePath:
+		# Move the response into place once it's all written, so an interrupted run never caches half of one
+		os.makedirs(os.path.dirname(cachePath), exist_ok=True)
+		with tempfile.NamedTemporaryFile(dir=os.path.dirname(cachePath), suffix=".part", delete=False) as cachedFile:
+			cachedFile.write(content.getbuffer())
+		os.replace(cachedFile.name, cachePath)
+
+	return content
+
+def submitPiecesToPolly(executor, polly, pieces, voiceID, cacheDir=None):
+	# Keep at most POLLY_PIECE_WINDOW pieces in flight, handing them back in order
+	pending = deque()
+	for piece in pieces:
+		pending.append((
+			piece,
+			executor.submit(synthesizePieceWithPolly, polly, piece, voiceID, "mp3", cacheDir),
+			executor.submit(synthesizePieceWithPolly, polly, piece, voiceID, "json", cacheDir),
+		))
+		if len(pending) >= POLLY_PIECE_WINDOW:
+			yield pending.popleft()
+
+	while pending:
+		yield pending.popleft()
+
+def renderID3Tag(metadata):
+	# The tag only depends on the metadata, so it can be rendered before any of the audio exists
+	tags = ID3()
+	for metaTag, id3Frame in ID3_FRAMES:
+		value = metadata.get(metaTag)
+		if value is not None:
+			tags.add(id3Frame(encoding=3, text=str(value)))
+
+	tags.add(TCON(encoding=3, text="(183)")) # u'Audiobook' should be equivalent to 183
+	tagBuffer = BytesIO()
+	tags.save(tagBuffer)
+	return tagBuffer.getvalue()
+
+def readEntryWithPolly(entry ,outfilename, voiceID, polly, cacheDir=None):
+	# Several chapters can be read at once, so progress goes through logging to keep the lines whole
+	logger.info("Printing out mp3: %s with voiceID: %s", outfilename, voiceID)
 	
 	i = 1
 	pieces = entry["ssml"]
+	outBaseName = os.path.basename(outfilename)
 
 	# pieces = [pieces[0]]
-	chapterJSON = ""
+	chapterJSON = BytesIO()
+
+	# The tag goes in first and the audio is streamed in after it, into a partial
+	# file that only replaces the MP3 once every piece has been written
+	partialFileName = outfilename + ".part"
 
-	with open(outfilename, "wb") as out:
-		for piece in pieces:
-			print("Writing Piece " + str(i) + " out of " + str(len(pieces)))
+	# Both requests of several pieces are made at once, but written out in order
+	with ThreadPoolExecutor(max_workers=2*POLLY_PIECE_WINDOW) as executor, open(partialFileName, "wb") as mp3File:
+		mp3File.write(renderID3Tag(entry["metaTags"]))
+		for piece, audioRequest, jsonRequest in submitPiecesToPolly(executor, polly, pieces, voiceID, cacheDir):
+			logger.info("%s: Writing Piece %d out of %d", outBaseName, i, len(pieces))
 			# piece = piece.replace("\n","")
 			# print(piece)
 
 			try:
-				responseAudio = polly.synthesize_speech(Text=piece, TextType="ssml", OutputFormat="mp3",VoiceId=voiceID)
-				responseJSON = polly.synthesize_speech(Text=piece, TextType="ssml", OutputFormat="json",SpeechMarkTypes=["ssml","sentence"],VoiceId=voiceID)
-			except (BotoCoreError, ClientError) as error:
-				print(error)
-				print(piece)
-				sys.exit(-1)
-
-			if "AudioStream" in responseJSON:
-				with closing(responseJSON["AudioStream"]) as stream:
-					try:
-						chapterJSON = chapterJSON + stream.read().decode("utf-8")
-					except IOError as error:
-						print(error)
-						print(piece)
-						sys.exit(-1)
-
-			if "AudioStream" in responseAudio:
-				with closing(responseAudio["AudioStream"]) as stream:
-					try:
-						out.write(stream.read())
-					except IOError as error:
-						print(error)
-						print(piece)
-						sys.exit(-1)
-			else:
-				print("Could not stream audio")
-				print(piece)
+				copyfileobj(jsonRequest.result(), chapterJSON, COPY_BUFFER_SIZE)
+				copyfileobj(audioRequest.result(), mp3File, COPY_BUFFER_SIZE)
+			except (BotoCoreError, ClientError, IOError) as error:
+				logger.error("%s: %s", outBaseName, error)
+				logger.error("%s", piece)
+				executor.shutdown(wait=False, cancel_futures=True)
+				mp3File.close()
+				os.remove(partialFileName)
 				sys.exit(-1)
 
 			i=i+1
 
+	os.replace(partialFileName, outfilename)
+
+	chapterJSON = chapterJSON.getvalue().decode("utf-8")
 	ssmlJSON ="[" + ','.join(chapterJSON[:-1].split('\n')) + "]"
 	ssmlJSON = json.loads(ssmlJSON)
 
 	entry["returnSSML"] = ssmlJSON
 
-	return ssmlJSON
-
 def applyMetadata2MP3(entry, mp3FileName):
 	entry["mp3"] = mp3FileName
 
 	metadata = entry["metaTags"]
 
-	audiofile = eyed3.load(mp3FileName)
-	if "ARTIST" in metadata:
-		audiofile.tag.artist = metadata["ARTIST"]
+	# Collect the lyric lines and join them once at the end
+	lyricParts = [
+		f"[ar:{metadata['ARTIST']}]\n\n",
+		f"[al:{metadata['ALBUM']}]\n\n",
+		f"[ti:{metadata['TITLE']}]\n\n",
+	]
+	# Each piece's marks restart at zero, so first place every sentence on the entry's timeline
+	sentenceMarks = []
+	currentTimeZero = 0
+	for ssmlMark in entry["returnSSML"]:
+		markType = ssmlMark["type"]
+		if markType == u"sentence":
+			sentenceMarks.append((ssmlMark["time"] + currentTimeZero, ssmlMark["value"]))
+		elif markType == u"ssml" and ssmlMark["value"] == u"end":
+			currentTimeZero = currentTimeZero + ssmlMark["time"]
 
-	if "ALBUM" in metadata:
-		audiofile.tag.album = metadata["ALBUM"]
+	for markTime, value in sentenceMarks:
+		minutes, milliseconds = divmod(markTime, 60 * 1000)
+		seconds, milliseconds = divmod(milliseconds, 1000)
+		hundredths = milliseconds // 10
+		lyricParts.append(f"[{minutes:02d}:{seconds:02d}.{hundredths:02d}]{value}\n")
 
-	if "ALBUMARTIST" in metadata:
-		audiofile.tag.album_artist = metadata["ALBUMARTIST"]
+	mp3BaseName = os.path.splitext(mp3FileName)[0]
+	lyricFileName = mp3BaseName + ".lrc"
+	Path(lyricFileName).write_text("".join(lyricParts), encoding="utf-8")
 
-	if "TITLE" in metadata:
-		audiofile.tag.title = metadata["TITLE"]
+	textOut = "".join(paragraph["text"] + "\n\n" for paragraph in entry["paragraphs"])
 
-	if "TRACK" in metadata:
-		audiofile.tag.track_num = metadata["TRACK"]
+	textFileName = mp3BaseName + ".txt"
+	Path(textFileName).write_text(textOut, encoding="utf-8")
 
-	audiofile.tag.genre = 183 # u'Audiobook' should be equivalent to 183
-	audiofile.tag.save()
-	
-	lyric = ""
-	lyric = lyric + "[ar:{artist}]\n\n".format(artist = metadata["ARTIST"])
-	lyric = lyric + "[al:{album}]\n\n".format(album = metadata["ALBUM"])
-	lyric = lyric + "[ti:{title}]\n\n".format(title = metadata["TITLE"])
-	currentTimeZero = 0
-	for ssmlMark in entry["returnSSML"]:
-		if ssmlMark["type"] == u"sentence":
-			time = ssmlMark["time"] + currentTimeZero
-			minutes = time // (60 * 1000)
-			time = time - minutes * (60 * 1000)
-			seconds = time // 1000
-			time = time - seconds * 1000
-			hundredths = time // 10
-
-			value = ssmlMark["value"]
-			lyric = lyric + "[{mm:02d}:{ss:02d}.{xx:02d}]{value}\n".format(mm = minutes, ss = seconds, xx = hundredths, value = value)
-
-		elif ssmlMark["type"] == u"ssml" and ssmlMark["value"] == u"end":
-			currentTimeZero = currentTimeZero + ssmlMark["time"]
+def writeEntry(entry, fullPath, voice, polly, noRead, fullJSON, cacheDir):
+	metadata = entry["metaTags"]
+	if not metadata["TITLE"]:
+		metadata["TITLE"] = ""
+
+	entryBaseName = f"{metadata['TRACK']} - {metadata['TITLE']}"
+	entryJSONfn = entryBaseName + ".fulldata.json"
+	entryMP3fn = entryBaseName + ".mp3"
+	entryJSONpath = os.path.join(fullPath,entryJSONfn)
+	entryMP3path = os.path.join(fullPath,entryMP3fn)
 
-	lyricFileName = os.path.splitext(mp3FileName)[0] + ".lrc"
-	with open(lyricFileName, "w") as lrc_file:
-		lrc_file.write(lyric)
+	if not noRead and "ssml" in entry:
+		readEntryWithPolly(entry ,entryMP3path, voice, polly, cacheDir)
 
-	textOut = ""
-	for paragraph in entry["paragraphs"]:
-		textOut += paragraph["text"] + "\n\n"
+		applyMetadata2MP3(entry, entryMP3path)
 
-	textFileName = os.path.splitext(mp3FileName)[0] + ".txt"
-	with open(textFileName, "w") as txt_file:
-		txt_file.write(textOut)
+	# The SSML and its speech marks are most of an entry, and are already in the MP3 and LRC
+	if not fullJSON:
+		entry = {key: value for key, value in entry.items() if key not in ("ssml", "returnSSML")}
+
+	# orjson's indenting and key sorting run in C, unlike json.dump's pretty printer
+	with open(entryJSONpath, 'wb') as fp:
+		fp.write(orjson.dumps(entry, option=orjson.OPT_INDENT_2 | orjson.OPT_SORT_KEYS))
 
 def main(args):
-	pp = pprint.PrettyPrinter(indent=4)
 	EPUB_Locaiton = validateEpubLocation(args.epub_location)
 	
 	# Open EPUB as Zip
 	with zipfile.ZipFile(EPUB_Locaiton) as epub_zip_file:
 		validateEPUBZip(epub_zip_file)
-
-	with zipfile.ZipFile(EPUB_Locaiton) as epub_zip_file:
 		loadedEPUBFileDict, extractedImageLocations, metadataDict, entryList = readInitialEPUBFiles(epub_zip_file, ignoreTOC = args.noTOC)
 
 	entryList = applyEPUBMetaTags(metadataDict, entryList)
@@ -1040,38 +1196,41 @@ def main(args):
 	if args.endChapterNum:
 		likelyTextEndIndex= args.endChapterNum
 
+	# The chapters to read, sliced once (slicing already stops at the end of the list)
+	chapterEntryList = entryList[likelyTextStartIndex:likelyTextEndIndex+1]
+
 
 	print("Cover Image: " + coverImageLocation)
-	if likelyTOCEntryIndex:
-		print("Likely Table of Contents Entry:")
-		paragraphIndex = 0
-		for index in range(len(entryList[likelyTOCEntryIndex]["paragraphs"])):
-			paragraph = entryList[likelyTOCEntryIndex]["paragraphs"][index]
-			if "table of content" in paragraph["text"].lower():
-				paragraphIndex = index
-				break
-
-		pp.pprint({
-					"text":entryList[likelyTOCEntryIndex]["text"],
-					"xml":entryList[likelyTOCEntryIndex]["xml"],
-					"ssmlLength":len(entryList[likelyTOCEntryIndex]["ssml"]),
-					"paragraph":entryList[likelyTOCEntryIndex]["paragraphs"][paragraphIndex]
-				})
 
-	print("All Entries:")
-	printEntryList = []
-	for entry in entryList:
-		currentEntry = copy.deepcopy(entry)
-		if "ssml" in currentEntry:
-			currentEntry["ssml"] = len(currentEntry["ssml"])
-		if "paragraphs" in currentEntry:
-			currentEntry["paragraphs"] = len(currentEntry["paragraphs"])
-		printEntryList.append(currentEntry)
-	pp.pprint(printEntryList)
+	# The entry dumps get large on long books, so they are only formatted for --verbose
+	verbose = logger.isEnabledFor(logging.DEBUG)
+	# There's no TOC paragraph to show if the entry didn't end up with any paragraphs
+	if verbose and likelyTOCEntryIndex and entryList[likelyTOCEntryIndex].get("paragraphs"):
+		tocEntry = entryList[likelyTOCEntryIndex]
+		paragraphIndex = next((index for index, paragraph in enumerate(tocEntry["paragraphs"]) if "table of content" in paragraph["text"].lower()), 0)
+
+		logger.debug("Likely Table of Contents Entry:\n%s", pprint.pformat({
+					"text":tocEntry["text"],
+					"xml":tocEntry["xml"],
+					"ssmlLength":len(tocEntry["ssml"]),
+					"paragraph":tocEntry["paragraphs"][paragraphIndex]
+				}, indent=4))
+
+	if verbose:
+		printEntryList = []
+		for entry in entryList:
+			# Only the top level keys are replaced for printing, so a shallow copy leaves the entry as it is
+			currentEntry = dict(entry)
+			if "ssml" in currentEntry:
+				currentEntry["ssml"] = len(currentEntry["ssml"])
+			if "paragraphs" in currentEntry:
+				currentEntry["paragraphs"] = len(currentEntry["paragraphs"])
+			printEntryList.append(currentEntry)
+		logger.debug("All Entries:\n%s", pprint.pformat(printEntryList, indent=4))
 
 	print("Likely Textual Chapter Range:" + "(" + str(likelyTextStartIndex) + "," + str(likelyTextEndIndex) + ")")
 	trackNum = 1
-	for entry in entryList[likelyTextStartIndex:min(len(entryList),likelyTextEndIndex+1)]:
+	for entry in chapterEntryList:
 		print(str(entry["index"]) + " --- " + str(entry["text"]))
 
 		if "ssml" in entry:
@@ -1079,19 +1238,17 @@ def main(args):
 		else:
 			print("SSML Length: " + str(0))
 
-		if "images" in entry:
-			print("Images:")
-			pp.pprint(entry["images"])
+		if "images" in entry and verbose:
+			logger.debug("Images:\n%s", pprint.pformat(entry["images"], indent=4))
 
 		if "metaTags" in entry:
 			entry["metaTags"]["TRACK"] = trackNum
 			trackNum += 1
-			print("Metadata")
-			pp.pprint(entry["metaTags"])
+			if verbose:
+				logger.debug("Metadata\n%s", pprint.pformat(entry["metaTags"], indent=4))
 
-		if "xml" in entry:
-			print("XML Listing:")
-			pp.pprint(entry["xml"])
+		if "xml" in entry and verbose:
+			logger.debug("XML Listing:\n%s", pprint.pformat(entry["xml"], indent=4))
 
 		# print()
 		# pp.pprint(entry)
@@ -1100,18 +1257,9 @@ def main(args):
 	startEntry = entryList[likelyTextStartIndex]
 	metadata = startEntry["metaTags"]
 
-	artist = None
-	if "ARTIST" in metadata:
-		artist = metadata["ARTIST"]
-
-	album = None
-	if "ALBUM" in metadata:
-		album = metadata["ALBUM"]
-
-
-	year = None
-	if "YEAR" in metadata:
-		year = metadata["YEAR"]
+	artist = metadata.get("ARTIST")
+	album = metadata.get("ALBUM")
+	year = metadata.get("YEAR")
 
 	if year:
 		yearString = "[" + year + "] "
@@ -1128,41 +1276,44 @@ def main(args):
 	else:
 		fullPath = os.path.join(yearString + albumString)
 	
-	try:
-		os.makedirs(fullPath)
-	except OSError as error:
-		pass
+	os.makedirs(fullPath, exist_ok=True)
 	print(fullPath)
 
-	voice="Amy"
-	for entry in entryList[likelyTextStartIndex:min(len(entryList),likelyTextEndIndex+1)]:
-		metadata = entry["metaTags"]
-		if not metadata["TITLE"]:
-			metadata["TITLE"] = ""
-
-		entryJSONfn = str(metadata["TRACK"]) + " - " + str(metadata["TITLE"]) + ".fulldata.json"
-		entryMP3fn = str(metadata["TRACK"]) + " - " + str(metadata["TITLE"]) + ".mp3"
-		entryJSONpath = os.path.join(fullPath,entryJSONfn)
-		entryMP3path = os.path.join(fullPath,entryMP3fn)
-
-		if "images" in entry:
-			for imagePath in entry["images"]:
-				baseImageName = os.path.basename(imagePath)
-				imageOutPath = os.path.join(fullPath,baseImageName)
-				copyfile(imagePath, imageOutPath)
+	# Every chapter's images and the cover go into the same folder, so copy each output file once (the
+	# last image with that name wins, as before, with the cover last) and let the copies overlap
+	imageCopies = {}
+	for entry in chapterEntryList:
+		for imagePath in entry.get("images", []):
+			imageCopies[os.path.join(fullPath,os.path.basename(imagePath))] = imagePath
 
-		if not args.noRead and "ssml" in entry:
-			readEntryWithPolly(entry ,entryMP3path, voice)
-
-			applyMetadata2MP3(entry, entryMP3path)
+	if coverImageLocation:
+		imageCopies[os.path.join(fullPath,os.path.basename(coverImageLocation))] = coverImageLocation
 
-		with open(entryJSONpath, 'w') as fp:
-			json.dump(entry, fp, sort_keys=True, indent=2)
+	with ThreadPoolExecutor(max_workers=IMAGE_COPY_WORKERS) as executor:
+		list(executor.map(copyfile, imageCopies.values(), imageCopies.keys()))
 
-	if coverImageLocation:
-		baseImageName = os.path.basename(coverImageLocation)
-		imageOutPath = os.path.join(fullPath,baseImageName)
-		copyfile(coverImageLocation, imageOutPath)
+	voice="Amy"
+	cacheDir = None if args.noCache else args.cacheDir
+
+	# One client is shared by every chapter, its pool holding each chapter's window of requests,
+	# with adaptive retries backing off when Polly throttles them
+	polly = None
+	if not args.noRead:
+		session = Session() #profile_name="adminuser")
+		polly = session.client("polly", config=Config(
+			max_pool_connections=CHAPTER_WORKERS*2*POLLY_PIECE_WINDOW,
+			retries={"max_attempts": 10, "mode": "adaptive"},
+		))
+	# The chapters don't depend on each other, so several are read and written at once
+	with ThreadPoolExecutor(max_workers=CHAPTER_WORKERS) as executor:
+		entryFutures = [executor.submit(writeEntry, entry, fullPath, voice, polly, args.noRead, args.fullJSON, cacheDir) for entry in chapterEntryList]
+		for entryFuture in entryFutures:
+			try:
+				entryFuture.result()
+			except BaseException:
+				# Don't start the chapters still waiting once one has failed
+				executor.shutdown(wait=False, cancel_futures=True)
+				raise
 
 
 if __name__ == "__main__":
@@ -1173,5 +1324,13 @@ if __name__ == "__main__":
 	parser.add_argument("--startChapterNum", help="Overwriting the start chapter number", type=int, default=None)
 	parser.add_argument("--endChapterNum", help="Overwriting the ending chapter number", type=int, default=None)
 	parser.add_argument("--noRead", help="Turn off polly reading for debugging", action='store_true', default=False)
+	parser.add_argument("--cacheDir", help="Where to cache Polly's responses, so re-runs only request the pieces that changed", default=DEFAULT_CACHE_DIR)
+	parser.add_argument("--noCache", help="Always request every piece from Polly, without reading or writing the cache", action='store_true', default=False)
+	parser.add_argument("--fullJSON", help="Keep the SSML and speech marks in each chapter's .fulldata.json", action='store_true', default=False)
+	parser.add_argument("--verbose", help="Also print the parsed manifest, spine, NCX and entry listings for debugging", action='store_true', default=False)
 	args = parser.parse_args()
+	logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO, format="%(message)s")
+	# Keep the AWS SDK's own debug output out of the verbose listings
+	logging.getLogger("botocore").setLevel(logging.WARNING)
+	logging.getLogger("urllib3").setLevel(logging.WARNING)
 	main(args)
\ No newline at end of file